@@ -59,9 +59,14 @@ def lock_items(modeladmin, request, queryset):
 lock_items.short_description = "Lock selected Queue Items"
 
 def unlock_items(modeladmin, request, queryset):
-    queryset.update(locked=False)
+    queryset.update(locked=False, claim_token='', claimed_at=None)
 unlock_items.short_description = "Unlock selected Queue Items"
 
+def retry_items(modeladmin, request, queryset):
+    queryset.update(locked=False, failed=False, attempts=0, last_error='', 
+        claim_token='', claimed_at=None)
+retry_items.short_description = "Retry selected Queue Items"
+
 class SuperTagAdmin(admin.ModelAdmin):
     list_display = ('name', 'enabled', 'substitute', 'stype')
     ordering = ('name', )
@@ -132,9 +137,16 @@ class SuperTaggedItemAdmin(admin.ModelAdmin):
                 return HttpResponseRedirect(request.get_full_path())
             ctype = ContentType.objects.get(id=ctype_id)
             obj = ctype.get_object_for_this_type(id=obj_id)
-            from supertagging.modules import process
-            process(obj)
-            msg = "Supertags have been updated."
+            from supertagging.modules import process, add_to_queue
+            from supertagging.calais import CalaisQuotaExceeded, CircuitOpen
+            try:
+                process(obj, force=True)
+                msg = "Supertags have been updated."
+            except (CalaisQuotaExceeded, CircuitOpen), e:
+                # Calais can't be called right now, update the tags later
+                add_to_queue(obj)
+                msg = ("Tagging is paused: %s The object was queued and its "
+                    "supertags will be updated later." % e)
             self.message_user(request, msg)
             return HttpResponseRedirect(request.get_full_path())
         else:
@@ -176,8 +188,11 @@ class SuperTagRelationAdmin(admin.ModelAdmin):
     
     
 class SuperTagProcessQueueAdmin(admin.ModelAdmin):
-    list_display = ('__unicode__', 'locked')
-    actions = [lock_items, unlock_items]
+    list_display = ('__unicode__', 'priority', 'enqueued_at', 'locked', 
+        'claimed_at', 'attempts', 'failed')
+    ordering = ('-priority', 'enqueued_at')
+    list_filter = ('failed', 'locked')
+    actions = [lock_items, unlock_items, retry_items]
     
 
 admin.site.register(SuperTag, SuperTagAdmin)
@@ -0,0 +1,124 @@
+"""
+Processes saved objects in background threads, so saving an object doesn't
+wait on Calais. Used when USE_QUEUE is off and BACKGROUND_WORKERS is set.
+"""
+import os, logging, threading, Queue
+from django.db import connection, transaction
+from django.contrib.contenttypes.models import ContentType
+
+from supertagging import settings
+from supertagging.utils import (start_commit_callbacks, stop_commit_callbacks,
+    run_commit_callbacks, on_commit)
+
+logger = logging.getLogger('supertagging')
+
+class BackgroundProcessor(object):
+    """
+    Runs ``target(ctype_id, object_id)`` in up to ``workers`` threads. At
+    most ``backlog`` objects wait for a thread; ``submit`` refuses more.
+    """
+    def __init__(self, workers, backlog, target):
+        self.workers = workers
+        self.target = target
+        self._tasks = Queue.Queue(backlog)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # Threads don't survive a fork, start new ones
+                self._pid = os.getpid()
+                self._threads = []
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            ctype_id, object_id = self._tasks.get()
+            try:
+                self.target(ctype_id, object_id)
+            except Exception:
+                logger.exception('Failed to process object %s of content '
+                    'type %s', object_id, ctype_id)
+            finally:
+                self._tasks.task_done()
+
+    def submit(self, ctype_id, object_id):
+        """
+        Schedule an object for processing. Returns False if the backlog
+        is full.
+        """
+        self._start()
+        try:
+            self._tasks.put_nowait((ctype_id, object_id))
+        except Queue.Full:
+            return False
+        return True
+
+@transaction.commit_on_success
+def _process(ctype_id, object_id):
+    from supertagging.calais import CalaisQuotaExceeded, CircuitOpen
+    from supertagging.modules import process, add_to_queue
+    model = ContentType.objects.get_for_id(ctype_id).model_class()
+    try:
+        obj = model._base_manager.get(pk=object_id)
+    except model.DoesNotExist:
+        return
+    try:
+        process(obj)
+    except (CalaisQuotaExceeded, CircuitOpen):
+        add_to_queue(obj)
+
+def _process_object(ctype_id, object_id):
+    start_commit_callbacks()
+    try:
+        _process(ctype_id, object_id)
+        run_commit_callbacks()
+    finally:
+        # Callbacks of a rolled back transaction are dropped
+        stop_commit_callbacks()
+        # Each thread has its own connection, don't leave it open
+        connection.close()
+
+_processor = None
+_processor_lock = threading.Lock()
+
+def get_processor():
+    global _processor
+    _processor_lock.acquire()
+    try:
+        if _processor is None:
+            _processor = BackgroundProcessor(settings.BACKGROUND_WORKERS,
+                settings.BACKGROUND_BACKLOG, _process_object)
+        return _processor
+    finally:
+        _processor_lock.release()
+
+def process_in_background(instance):
+    """
+    Process ``instance`` in a background thread once it is committed.
+
+    Before Django 1.9, an object saved inside a transaction is submitted 
+    at the end of the request. The object is added to the queue instead 
+    when the backlog is full, or when it is saved inside a transaction 
+    outside of a request, since a thread could read it before it is 
+    committed.
+    """
+    from supertagging.modules import add_to_queue
+    ctype_id = ContentType.objects.get_for_model(instance).pk
+    object_id = instance.pk
+
+    def submit():
+        if not get_processor().submit(ctype_id, object_id):
+            add_to_queue(instance)
+
+    if not on_commit(submit):
+        add_to_queue(instance)
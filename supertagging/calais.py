@@ -6,7 +6,7 @@ Last-Update: 01/12/2009
 1.5 updated by Corey Oordt 8/3/2011
 """
 
-import httplib, urllib, re
+import httplib, urllib, re, os, socket, errno, threading, time, datetime, Queue
 import simplejson as json
 from StringIO import StringIO
 
@@ -35,6 +35,9 @@ VALID_OUTPUT_TYPES = (
 
 VALID_BOOLEANS = ('true', 'false', 't', 'f',)
 
+API_HOST = "api.opencalais.com:80"
+API_PATH = "/tag/rs/enrich"
+
 VALID_METADATA_TYPES = (
     "GenericRelations", 
     "SocialTags",
@@ -46,6 +49,455 @@ class AppURLopener(urllib.FancyURLopener):
     version = "Mozilla/5.0 (X11; U; Linux x86_64; en-US; rv:1.9.0.5) Gecko/2008121623 Ubuntu/8.10 (intrepid)Firefox/3.0.5" # Lie shamelessly to Wikipedia.
 urllib._urlopener = AppURLopener()
 
+class ConnectionPool(object):
+    """
+    Keeps idle keep-alive connections to a host so consecutive requests do
+    not pay for a new TCP connection each time. Safe to share between threads.
+    """
+    connection_class = httplib.HTTPConnection
+
+    def __init__(self, host=API_HOST, size=4, timeout=None):
+        self.host = host
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _get(self):
+        """
+        Return an idle connection, or a new one. The second value is True
+        when the connection was reused.
+        """
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # Sockets inherited from a parent process can't be shared
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop(), True
+        finally:
+            self._lock.release()
+        return self.connection_class(self.host, timeout=self.timeout), False
+
+    def _put(self, conn):
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def request(self, method, url, body=None, headers={}):
+        """
+        Send a request and return (status, data). A reused connection that
+        the server has already closed is replaced and the request is sent
+        once more. Other failures, such as timeouts, are not retried since 
+        the server may have received the request.
+        """
+        while True:
+            conn, reused = self._get()
+            sent = False
+            try:
+                conn.request(method, url, body, headers)
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if reused and _closed_by_server(e, sent):
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._put(conn)
+            return response.status, data
+
+    def clear(self):
+        """
+        Close all idle connections.
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        for conn in idle:
+            conn.close()
+
+def _closed_by_server(error, sent):
+    """
+    True if ``error`` shows a kept-alive connection was closed by the 
+    server while idle, so the request can safely be sent again.
+    """
+    if isinstance(error, (httplib.CannotSendRequest, httplib.BadStatusLine)):
+        # Refused before sending, or closed without any answer
+        return True
+    if isinstance(error, socket.timeout):
+        return False
+    return not sent and isinstance(error, socket.error) and (
+        error.errno in (errno.ECONNRESET, errno.EPIPE))
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_connection_pool(host=API_HOST, size=4, timeout=None):
+    """
+    Return the pool shared by every client with the same host, size and
+    timeout.
+    """
+    key = (host, size, timeout)
+    _pools_lock.acquire()
+    try:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(host, size, timeout)
+        return _pools[key]
+    finally:
+        _pools_lock.release()
+
+class WorkerPool(object):
+    """
+    ``size`` daemon threads running the functions put in the pool, in the 
+    order they were put. The threads are started once and then reused.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.tasks = Queue.Queue()
+        for i in range(size):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+    
+    def _work(self):
+        while True:
+            func = self.tasks.get()
+            try:
+                func()
+            except Exception:
+                # Don't lose the thread to a failed function
+                pass
+    
+    def submit(self, func):
+        self.tasks.put(func)
+
+_worker_pools = {}
+
+def get_worker_pool(size=8):
+    """
+    Return the worker pool shared by every client of this process with the 
+    same size. Threads are not copied to a forked process, so it starts 
+    its own.
+    """
+    key = (os.getpid(), size)
+    _pools_lock.acquire()
+    try:
+        if key not in _worker_pools:
+            _worker_pools[key] = WorkerPool(size)
+        return _worker_pools[key]
+    finally:
+        _pools_lock.release()
+
+class CalaisUnavailable(Exception):
+    """
+    OpenCalais answered with a server error.
+    """
+    def __init__(self, status):
+        self.status = status
+        super(CalaisUnavailable, self).__init__('OpenCalais returned %s' % status)
+
+class CalaisThrottled(CalaisUnavailable):
+    """
+    OpenCalais asked us to slow down with a 429 or 503 response.
+    """
+    pass
+
+class CircuitOpen(Exception):
+    """
+    Requests are not sent because OpenCalais failed repeatedly.
+    """
+    pass
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests for ``reset_timeout`` seconds after 
+    ``failure_threshold`` requests in a row failed. After that a single 
+    trial request is let through: the circuit closes again if it succeeds, 
+    and stays open for another ``reset_timeout`` if it fails.
+    
+    ``listener``, if given, is called with the state, the number of 
+    consecutive failures and the time the circuit opened whenever the 
+    state changes. Safe to share between threads.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+    
+    def __init__(self, failure_threshold=5, reset_timeout=60, listener=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.listener = listener
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def _notify(self):
+        if self.listener:
+            self.listener(self.state, self.failures, self.opened_at)
+
+    def check(self):
+        """
+        Raise CircuitOpen if a request would be refused right now.
+        """
+        if self.state == self.HALF_OPEN or (self.state == self.OPEN and 
+            time.time() - self.opened_at < self.reset_timeout):
+            raise CircuitOpen('OpenCalais failed %s times in a row, not '
+                'sending requests.' % self.failures)
+
+    def before_call(self):
+        """
+        Raise CircuitOpen if the request must not be sent.
+        """
+        self._lock.acquire()
+        try:
+            changed = False
+            if self.state == self.OPEN and \
+                time.time() - self.opened_at >= self.reset_timeout:
+                self.state, changed = self.HALF_OPEN, True
+            else:
+                self.check()
+        finally:
+            self._lock.release()
+        if changed:
+            self._notify()
+
+    def record_success(self):
+        self._lock.acquire()
+        try:
+            changed = self.state != self.CLOSED
+            self.state, self.failures, self.opened_at = self.CLOSED, 0, None
+        finally:
+            self._lock.release()
+        if changed:
+            self._notify()
+
+    def record_throttled(self):
+        """
+        A throttled response doesn't count as a success or a failure. A 
+        trial request that is throttled keeps the circuit open for another 
+        ``reset_timeout``.
+        """
+        self._lock.acquire()
+        try:
+            changed = self.state == self.HALF_OPEN
+            if changed:
+                self.state, self.opened_at = self.OPEN, time.time()
+        finally:
+            self._lock.release()
+        if changed:
+            self._notify()
+
+    def record_failure(self):
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            changed = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and 
+                self.failures >= self.failure_threshold):
+                self.state, self.opened_at, changed = self.OPEN, time.time(), True
+        finally:
+            self._lock.release()
+        if changed:
+            self._notify()
+
+_breakers = {}
+
+def get_circuit_breaker(failure_threshold, reset_timeout, listener=None):
+    """
+    Return the circuit breaker shared by every client with the same 
+    settings, or None if ``failure_threshold`` is not set.
+    """
+    if not failure_threshold:
+        return None
+    key = (failure_threshold, reset_timeout, listener)
+    _pools_lock.acquire()
+    try:
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(failure_threshold, reset_timeout, 
+                listener)
+        return _breakers[key]
+    finally:
+        _pools_lock.release()
+
+class CalaisQuotaExceeded(Exception):
+    """
+    The daily quota of requests is used up.
+    """
+    pass
+
+class RateLimiter(object):
+    """
+    Token bucket allowing ``rate`` requests per second on average and bursts
+    of up to ``burst`` requests, and at most ``daily_quota`` requests a day.
+    Either limit may be None. Safe to share between threads.
+    
+    Requests are counted in memory, or by ``counter`` when given: a 
+    function taking the date and returning the number of requests made 
+    that day, including this one, so the quota can be shared between 
+    processes.
+    """
+    def __init__(self, rate=None, burst=1, daily_quota=None, counter=None):
+        self.rate = rate and float(rate)
+        self.burst = burst
+        self.daily_quota = daily_quota
+        self.counter = counter
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._paused_until = 0
+        self._day, self._count = datetime.date.today(), 0
+        self._lock = threading.Lock()
+
+    def _count_request(self):
+        if not self.daily_quota:
+            return
+        today = datetime.date.today()
+        if self.counter:
+            count = self.counter(today)
+        else:
+            if self._day != today:
+                self._day, self._count = today, 0
+            self._count += 1
+            count = self._count
+        if count > self.daily_quota:
+            raise CalaisQuotaExceeded('Daily quota of %s requests used up.' %
+                self.daily_quota)
+
+    def wait(self):
+        """
+        Block until a request may be sent. Raises CalaisQuotaExceeded when 
+        the daily quota is used up.
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                now = time.time()
+                delay = self._paused_until - now
+                if delay <= 0 and self.rate:
+                    self._tokens = min(self.burst,
+                        self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._count_request()
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self.rate
+                elif delay <= 0:
+                    self._count_request()
+                    return
+            finally:
+                self._lock.release()
+            time.sleep(delay)
+
+    def backoff(self, seconds):
+        """
+        Hold every request for ``seconds``.
+        """
+        self._lock.acquire()
+        try:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+        finally:
+            self._lock.release()
+
+_limiters = {}
+
+def get_rate_limiter(rate, daily_quota=None, counter=None):
+    """
+    Return the limiter shared by every client using the same limits, or 
+    None if neither is set.
+    """
+    if not (rate or daily_quota):
+        return None
+    key = (rate, daily_quota, counter)
+    _pools_lock.acquire()
+    try:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(rate, daily_quota=daily_quota, 
+                counter=counter)
+        return _limiters[key]
+    finally:
+        _pools_lock.release()
+
+# Where to split a document that is too large, best first
+SPLIT_POINTS = ('\n\n', '\n', '. ', ' ')
+
+def split_document(text, max_size):
+    """
+    Split ``text`` into chunks of at most ``max_size`` characters, at a 
+    paragraph break when possible, then at a line, sentence or word break. 
+    Returns a list of (offset, chunk); the chunks join back into ``text``.
+    """
+    chunks, start = [], 0
+    while len(text) - start > max_size:
+        window = text[start:start + max_size]
+        end = start + max_size
+        for point in SPLIT_POINTS:
+            i = window.rfind(point)
+            if i > 0:
+                end = start + i + len(point)
+                break
+        chunks.append((start, text[start:end]))
+        start = end
+    chunks.append((start, text[start:]))
+    return chunks
+
+def merge_responses(chunks):
+    """
+    Merge the raw JSON responses to the chunks of a document into the 
+    response to the whole document. ``chunks`` is a list of (offset, raw 
+    response) in document order.
+    
+    Instance offsets are moved by the chunk's offset. Entities and 
+    relations found in several chunks have the same reference and are 
+    collapsed into one, with all the instances and the highest relevance. 
+    Topics and social tags are collapsed by category and tag, keeping the 
+    highest score and importance.
+    """
+    merged, seen = {}, {}
+    for offset, raw in chunks:
+        for key, item in json.loads(raw).items():
+            group = item.get('_typeGroup') if isinstance(item, dict) else None
+            if group == 'topics':
+                ident = (group, item.get('category'))
+            elif group == 'socialTag':
+                ident = (group, item.get('socialTag'))
+            else:
+                ident = key
+            for inst in item.get('instances', []) if group else []:
+                if 'offset' in inst:
+                    inst['offset'] += offset
+            if ident not in seen:
+                seen[ident] = key
+                merged[key] = item
+                continue
+            if not group:
+                continue
+            existing = merged[seen[ident]]
+            if 'instances' in item:
+                existing['instances'] = existing.get('instances', []) + item['instances']
+            for attr in ('relevance', 'score'):
+                if attr in item:
+                    existing[attr] = max(existing.get(attr, 0), item[attr])
+            if 'importance' in item:
+                # 1 is the most important
+                existing['importance'] = min(existing.get('importance', item['importance']), 
+                    item['importance'])
+    return json.dumps(merged)
+
 class Calais():
     """
     Python class that knows how to talk to the OpenCalais API.  Use the analyze() and analyze_url() methods, which return CalaisResponse objects.  
@@ -66,9 +518,18 @@ class Calais():
         "submitter": "python-calais client v.%s" % __version__,
     }
     external_metadata = {}
+    # Times a throttled request is retried, waiting twice as long each time
+    max_retries = 3
+    backoff = 2
 
-    def __init__(self, api_key, submitter=None):
+    def __init__(self, api_key, submitter=None, pool=None, circuit_breaker=None):
         self.api_key = api_key
+        self.pool = pool or get_connection_pool()
+        self.circuit_breaker = circuit_breaker
+        # Don't share the class level directives between instances
+        self.processing_directives = self.processing_directives.copy()
+        self.user_directives = self.user_directives.copy()
+        self.external_metadata = self.external_metadata.copy()
         if submitter:
             self.user_directives["submitter"]=submitter
     
@@ -123,16 +584,35 @@ class Calais():
                 headers[key] = val
         return headers
     
-    def rest_POST(self, content):
+    def rest_POST(self, content, content_type=None):
         headers = {
             "x-calais-licenseID": self.api_key,
         }
         headers.update(self._get_param_headers())
-        conn = httplib.HTTPConnection("api.opencalais.com:80")
-        conn.request("POST", "/tag/rs/enrich", content.encode('utf8'), headers)
-        response = conn.getresponse()
-        data = response.read()
-        conn.close()
+        if content_type:
+            headers['Content-Type'] = content_type
+        body = content.encode('utf8')
+        breaker = self.circuit_breaker
+        if breaker:
+            breaker.before_call()
+        try:
+            status, data = self.pool.request("POST", API_PATH, body, headers)
+        except:
+            if breaker:
+                breaker.record_failure()
+            raise
+        if breaker:
+            # Being asked to slow down doesn't mean OpenCalais is down
+            if status in (429, 503):
+                breaker.record_throttled()
+            elif status >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        if status in (429, 503):
+            raise CalaisThrottled(status)
+        if status >= 500:
+            raise CalaisUnavailable(status)
         return data
 
     def get_random_id(self):
@@ -153,6 +633,8 @@ class Calais():
         """
         import hashlib
         h = hashlib.sha1()
+        if isinstance(text, unicode):
+            text = text.encode('utf8')
         h.update(text)
         return h.hexdigest()
 
@@ -169,6 +651,110 @@ class Calais():
             self.user_directives["externalID"] = external_id
         return CalaisResponse(self.rest_POST(content))
 
+    def analyze_many(self, texts, content_type="TEXT/RAW", max_workers=8, 
+        rate_limiter=None, max_size=None):
+        """
+        Analyze several texts at once with up to ``max_workers`` requests in 
+        flight, waiting on ``rate_limiter`` before each one. The requests 
+        are sent by the worker pool of that size, which every call shares.
+        
+        ``texts`` is a dict or a list; a value may also be a 
+        ``(text, content_type)`` pair. Yields ``(key, result)`` as each 
+        text completes, where key is the dict key or list index and 
+        result is a CalaisResponse, None for empty text, or the exception 
+        raised by the request. Throttled requests are retried after backing 
+        off, holding every request that shares ``rate_limiter``.
+        
+        A text longer than ``max_size`` characters is split with 
+        ``split_document``, its chunks are sent like separate texts and 
+        their responses merged with ``merge_responses``.
+        """
+        if hasattr(texts, 'items'):
+            texts = texts.items()
+        else:
+            texts = enumerate(texts)
+        tasks, results = [], Queue.Queue()
+        offsets = {}
+        for key, text in texts:
+            ctype = content_type
+            if isinstance(text, tuple):
+                text, ctype = text
+            chunks = [(0, text)]
+            if max_size and text and len(text) > max_size:
+                chunks = split_document(text, max_size)
+            offsets[key] = [offset for offset, chunk in chunks]
+            for index, (offset, chunk) in enumerate(chunks):
+                tasks.append((key, index, chunk, ctype))
+        count = len(tasks)
+        cancelled = threading.Event()
+        
+        def post(key, index, text, ctype):
+            # The caller stopped iterating, nobody wants the result
+            if cancelled.is_set():
+                return
+            try:
+                result = None
+                if text and len(text.strip()):
+                    result = self._post_with_retries(text, ctype, rate_limiter)
+            except Exception, e:
+                result = e
+            results.put((key, index, result))
+        
+        pool = get_worker_pool(max_workers)
+        for task in tasks:
+            pool.submit(lambda task=task: post(*task))
+        try:
+            parts = {}
+            for i in range(count):
+                key, index, result = results.get()
+                if len(offsets[key]) == 1:
+                    yield key, result
+                    continue
+                parts.setdefault(key, {})[index] = result
+                if len(parts[key]) == len(offsets[key]):
+                    yield key, self._merge_chunks(offsets[key], parts.pop(key))
+        finally:
+            # Skip the requests not sent yet if the caller stops iterating
+            cancelled.set()
+
+    def _merge_chunks(self, offsets, results):
+        """
+        The response to a document from the ``results`` of its chunks, 
+        keyed by chunk index: the first exception if any chunk failed.
+        """
+        chunks = []
+        for index, offset in enumerate(offsets):
+            result = results[index]
+            if isinstance(result, Exception):
+                return result
+            if result is not None:
+                chunks.append((offset, result.raw_result))
+        if not chunks:
+            return None
+        return CalaisResponse(merge_responses(chunks))
+
+    def _post_with_retries(self, content, content_type, rate_limiter=None):
+        for attempt in range(self.max_retries + 1):
+            # Fail fast before using up any of the rate or quota
+            if self.circuit_breaker:
+                self.circuit_breaker.check()
+            if rate_limiter:
+                rate_limiter.wait()
+            try:
+                return CalaisResponse(self.rest_POST(content, content_type))
+            except CalaisThrottled:
+                if attempt == self.max_retries:
+                    # Still throttled after every retry, count the document 
+                    # as one failure
+                    if self.circuit_breaker:
+                        self.circuit_breaker.record_failure()
+                    raise
+                delay = self.backoff * 2 ** attempt
+                if rate_limiter:
+                    rate_limiter.backoff(delay)
+                else:
+                    time.sleep(delay)
+
     def analyze_url(self, url):
         f = urllib.urlopen(url)
         html = self.preprocess_html(f.read())
@@ -198,10 +784,12 @@ class CalaisResponse():
     """
     Encapsulates a parsed Calais response and provides easy pythonic access to the data.
     """
+    raw_result = None
     raw_response = None
     simplified_response = None
     
     def __init__(self, raw_result):
+        self.raw_result = raw_result
         try:
             self.raw_response = json.load(StringIO(raw_result))
         except:
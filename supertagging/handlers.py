@@ -1,16 +1,109 @@
+import copy
+
 from django.db.models import get_model
-from django.db.models.signals import post_save, post_delete
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import post_save, post_delete, post_init
 
 from supertagging.settings import USE_QUEUE, MODULES, AUTO_PROCESS, ST_DEBUG, MARKUP, MARKUP_FIELD_SUFFIX, REGISTER_MODELS
+from supertagging import settings as st_settings
 from supertagging import register
 
+SNAPSHOT_ATTR = '_supertagging_snapshot'
+
+# The attribute names that affect tagging, for each model
+_watched_attnames = {}
+
+def get_watched_attnames(model):
+    """
+    Return the attribute names of the fields that are sent to Calais or 
+    decide how the model is tagged: the ``fields``, ``combine_fields``, 
+    ``match_kwargs`` and date field. Returns None if one of them is not a 
+    model field, such as a property, and can't be tracked.
+    """
+    if model not in _watched_attnames:
+        params = st_settings.MODULES.get('%s.%s' % (model._meta.app_label, 
+            model._meta.module_name), {})
+        names = set()
+        for f in params.get('fields', []):
+            names.update(f.get('combine_fields') or [f.get('name')])
+        names.update([k.split('__')[0] for k in params.get('match_kwargs', {})])
+        names.discard('pk')
+        date_field = params.get('date_field', model._meta.get_latest_by)
+        if date_field:
+            names.add(date_field)
+        attnames = set()
+        for name in names:
+            try:
+                attnames.add(model._meta.get_field(name).attname)
+            except FieldDoesNotExist:
+                attnames = None
+                break
+        _watched_attnames[model] = attnames
+    return _watched_attnames[model]
+
+def take_snapshot(instance):
+    """
+    Remember the values of the watched fields that are loaded. Deferred 
+    fields are left out rather than fetched.
+    """
+    attnames = get_watched_attnames(instance.__class__)
+    if attnames is None:
+        return
+    snapshot = {}
+    for attname in attnames:
+        if attname in instance.__dict__:
+            snapshot[attname] = copy.copy(instance.__dict__[attname])
+    setattr(instance, SNAPSHOT_ATTR, snapshot)
+
+def has_watched_changes(instance, created=False, update_fields=None):
+    """
+    Whether the save of ``instance`` may change its tags.
+    """
+    if created or not st_settings.SKIP_UNCHANGED_CONTENT:
+        return True
+    attnames = get_watched_attnames(instance.__class__)
+    snapshot = getattr(instance, SNAPSHOT_ATTR, None)
+    if attnames is None or snapshot is None:
+        return True
+    if update_fields is not None:
+        update_attnames = set()
+        for name in update_fields:
+            try:
+                update_attnames.add(instance._meta.get_field(name).attname)
+            except FieldDoesNotExist:
+                update_attnames.add(name)
+        if not attnames & update_attnames:
+            return False
+    for attname in attnames:
+        if attname not in snapshot or attname not in instance.__dict__:
+            return True
+        if snapshot[attname] != instance.__dict__[attname]:
+            return True
+    return False
+
+def init_handler(sender, instance, **kwargs):
+    take_snapshot(instance)
+
 def save_handler(sender, instance, **kwargs):
     if instance:
+        if not has_watched_changes(instance, kwargs.get('created', False), 
+            kwargs.get('update_fields')):
+            return
         from supertagging.modules import process, add_to_queue 
         if USE_QUEUE:
             add_to_queue(instance)
+        elif st_settings.BACKGROUND_WORKERS:
+            from supertagging.background import process_in_background
+            process_in_background(instance)
         else:
-            process(instance)
+            from supertagging.calais import CalaisQuotaExceeded, CircuitOpen
+            try:
+                process(instance)
+            except (CalaisQuotaExceeded, CircuitOpen):
+                # Don't fail the save, try again later from the queue
+                add_to_queue(instance)
+        # The saved values are what the next save is compared with
+        take_snapshot(instance)
 
 def delete_handler(sender, instance, **kwargs):
     if instance:
@@ -32,6 +125,7 @@ def setup_handlers():
             
             # Setup post save and post delete handlers if model exists
             if model and AUTO_PROCESS:
+                post_init.connect(init_handler, sender=model)
                 post_save.connect(save_handler, sender=model)
                 post_delete.connect(delete_handler, sender=model)
             
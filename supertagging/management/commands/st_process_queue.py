@@ -1,63 +1,311 @@
 #!/usr/bin/python
-import time
+import os, signal, threading, time, uuid
+from optparse import make_option
+from multiprocessing import Pool, active_children
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import transaction, connection, reset_queries
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 
 from supertagging.models import SuperTagProcessQueue
 from supertagging.modules import process
+from supertagging.calais import CalaisQuotaExceeded, CircuitOpen
+from supertagging.utils import (start_commit_callbacks, stop_commit_callbacks,
+    run_commit_callbacks, discard_commit_callbacks, commit_callbacks_mark)
 from supertagging import settings as st_settings
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+            help='Number of worker processes.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=100, help='Number of queue items a worker claims at once.'),
+        make_option('--commit-every', type='int', dest='commit_every',
+            default=1, help='Commit after this many processed objects.'),
+        make_option('--commit-interval', type='float', dest='commit_interval',
+            default=None, help='Commit at least every this many seconds.'),
+        make_option('--daemon', action='store_true', dest='daemon',
+            default=False, help='Keep polling the queue until stopped '
+            'with SIGTERM.'),
+        make_option('--poll-interval', type='float', dest='poll_interval',
+            default=1, help='Seconds to wait when the queue is empty, '
+            'doubling while it stays empty.'),
+        make_option('--max-poll-interval', type='float', 
+            dest='max_poll_interval', default=60,
+            help='Most seconds to wait when the queue is empty.'),
+    )
+
     def handle(self, *args, **kwargs):
-        c = Core()
-        c.execute()
+        workers = kwargs['workers']
+        options = dict([(k, kwargs[k]) for k in ('batch_size', 'commit_every', 
+            'commit_interval', 'daemon', 'poll_interval', 'max_poll_interval')])
+        if options['daemon']:
+            # Installed before the workers start, so they inherit it
+            signal.signal(signal.SIGTERM, stop)
+        if workers > 1:
+            connection.close()
+            pool = Pool(workers)
+            try:
+                result = pool.map_async(run_worker, [(workers, options)] * workers)
+                # Wait with a timeout so signals are handled meanwhile
+                while not result.ready():
+                    result.wait(1)
+                results = result.get()
+            finally:
+                pool.close()
+                pool.join()
+            processed = sum([r[0] for r in results])
+            failed = sum([r[1] for r in results])
+            print '%s of %s objects processed by %s workers. %s failed.' % (
+                processed, processed + failed, workers, failed)
+        else:
+            c = Core(**options)
+            c.execute()
+
+
+_stop = threading.Event()
+
+def stop(signum, frame):
+    """
+    Ask the workers to stop once they finish their current batch.
+    """
+    if not _stop.is_set():
+        print 'Stopping after the current batch...'
+        _stop.set()
+        # Pass the signal on in case it was only sent to the parent
+        for child in active_children():
+            os.kill(child.pid, signum)
+
+def run_worker(args):
+    workers, options = args
+    # Each worker needs its own database connection, not the parent's.
+    connection.close()
+    # The rate applies to all workers together, give each one its share.
+    # The daily quota is already shared through the cache.
+    rate = st_settings.OPEN_CALAIS['REQUESTS_PER_SECOND']
+    if rate:
+        options = dict(options, requests_per_second=float(rate) / workers)
+    return Core(**options).execute()
 
 
 class Core(object):
     """
     The Core is responsible for driving Supertagging
+    
+    Any number of Cores, in one or many processes or hosts, can drain the 
+    queue at the same time. Each claims batches of items with its own 
+    token, so an item is only processed by one of them.
+    
+    Work is committed after ``commit_every`` processed objects or 
+    ``commit_interval`` seconds, whichever comes first, together with the 
+    removal of those objects from the queue. Each object is processed in 
+    a savepoint so a failure only undoes that object. Databases without 
+    savepoints commit after every object.
+    
+    As a ``daemon`` it keeps polling the queue until stopped, waiting 
+    ``poll_interval`` seconds when the queue is empty and twice as long 
+    each time it is still empty, up to ``max_poll_interval``. The database 
+    connection, the Calais connections and the tag cache are reused from 
+    one batch to the next. A commit that fails rolls back and hands the 
+    batch back to the queue, and the worker carries on.
+    
+    ``requests_per_second`` overrides the REQUESTS_PER_SECOND setting, so 
+    workers running side by side can split the rate between them.
     """ 
+    def __init__(self, batch_size=100, commit_every=1, commit_interval=None,
+        daemon=False, poll_interval=1, max_poll_interval=60, 
+        requests_per_second=None):
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.daemon = daemon
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.process_kwargs = {}
+        if requests_per_second:
+            self.process_kwargs['requests_per_second'] = requests_per_second
+        if not connection.features.uses_savepoints:
+            self.commit_every = 1
+        self.token = uuid.uuid4().hex
+    
+    def load_content_objects(self, objects):
+        """
+        Fetch the content objects of a batch of queue items with one query 
+        per content type, instead of one query per item. Objects a custom 
+        default manager filters out are still found, like related objects.
+        """
+        object_ids = {}
+        for obj in objects:
+            object_ids.setdefault(obj.content_type_id, []).append(obj.object_id)
+        content_objects = {}
+        for ctype_id, ids in object_ids.items():
+            model = ContentType.objects.get_for_id(ctype_id).model_class()
+            if model is None:
+                continue
+            for pk, instance in model._base_manager.in_bulk(ids).items():
+                content_objects[(ctype_id, pk)] = instance
+        for obj in objects:
+            instance = content_objects.get((obj.content_type_id, obj.object_id))
+            if instance is not None:
+                obj.content_object = instance
+            else:
+                setattr(obj, SuperTagProcessQueue.content_object.cache_attr, None)
+    
+    def savepoint(self):
+        if self.commit_every > 1:
+            return transaction.savepoint()
+    
+    def rollback(self, sid, mark=0):
+        """
+        Roll back to ``sid``, or the whole transaction if it is None, and 
+        drop the callbacks, like caching new tags, added since ``mark``.
+        """
+        if sid is None:
+            transaction.rollback()
+            mark = 0
+        else:
+            transaction.savepoint_rollback(sid)
+        discard_commit_callbacks(mark)
+    
     @transaction.commit_manually
     def execute(self):
         """
         The main execution path; this function is invoked by a scheduler.
         """
-        processed, failed, objs_to_del, objs_to_reset = 0, 0, [], []
-        print 'Getting objects to process...'
-        objects = SuperTagProcessQueue.objects.filter(locked=False)
-        print 'Done. %s object(s)' % len(objects)
-        print 'Locking object(s)...'
-        SuperTagProcessQueue.objects.filter(locked=False).update(locked=True)
-        transaction.commit()
-        print 'Done.'
-        for obj in objects:
-            print 'Processing: %s...' % obj
+        processed, failed, objs_to_reset = 0, 0, []
+        self.objs_to_del, self.last_commit = [], time.time()
+        idle = self.poll_interval
+        start_commit_callbacks()
+        while not _stop.is_set():
+            print 'Claiming objects to process...'
             try:
-                print 'Start processing object with calais...'
-                process(obj.content_object)
-                print 'Done'
-                objs_to_del.append(obj.pk)
-                print 'Committing calais data...'
+                objects = SuperTagProcessQueue.objects.claim(self.token, 
+                    self.batch_size)
                 transaction.commit()
-                print 'Done'
-                processed += 1
             except Exception, e:
-                print 'Failed to process object, rolling back... %s' % e
-                objs_to_reset.append(obj.pk)
-                transaction.rollback()
-                print 'Done'
-                failed += 1
-            time.sleep(1)
+                if not self.daemon:
+                    raise
+                # The database may be back by the next poll
+                print 'Failed to claim objects. %s' % e
+                self.hand_back([])
+                self.sleep(idle)
+                idle = min(idle * 2, self.max_poll_interval)
+                continue
+            print 'Done. %s object(s)' % len(objects)
+            if not objects:
+                # Failed objects stay locked until the queue is drained, 
+                # so they are not claimed again straight away.
+                SuperTagProcessQueue.objects.release(objs_to_reset)
+                transaction.commit()
+                objs_to_reset = []
+                if not self.daemon:
+                    break
+                # Don't hold a connection the database may time out
+                connection.close()
+                self.sleep(idle)
+                idle = min(idle * 2, self.max_poll_interval)
+                continue
+            idle = self.poll_interval
+            reset_queries()
+            self.load_content_objects(objects)
+            paused = False
+            for i, obj in enumerate(objects):
+                if obj.content_object is None:
+                    print 'Object %s of %s no longer exists.' % (
+                        obj.object_id, obj.content_type)
+                    self.objs_to_del.append(obj.pk)
+                    continue
+                print 'Processing: %s...' % obj
+                mark = commit_callbacks_mark()
+                sid = self.savepoint()
+                try:
+                    print 'Start processing object with calais...'
+                    process(obj.content_object, **self.process_kwargs)
+                    print 'Done'
+                    if sid is not None:
+                        transaction.savepoint_commit(sid)
+                    self.objs_to_del.append(obj.pk)
+                    processed += 1
+                except (CalaisQuotaExceeded, CircuitOpen), e:
+                    print '%s Handing back the rest of the batch.' % e
+                    self.rollback(sid, mark)
+                    # Hand back the rest of the batch for later
+                    SuperTagProcessQueue.objects.release(
+                        [o.pk for o in objects[i:]], attempted=False)
+                    paused = True
+                    break
+                except Exception, e:
+                    print 'Failed to process object, rolling back... %s' % e
+                    objs_to_reset.append(obj.pk)
+                    self.rollback(sid, mark)
+                    SuperTagProcessQueue.objects.record_failure(obj, e)
+                    failed += 1
+                    if sid is None:
+                        transaction.commit()
+                    print 'Done'
+                
+                if len(self.objs_to_del) >= self.commit_every or (
+                    self.commit_interval is not None and 
+                    time.time() - self.last_commit >= self.commit_interval):
+                    if not self.commit([o.pk for o in objects[i + 1:]]):
+                        break
             
+            self.commit()
+            if paused:
+                if not self.daemon:
+                    break
+                self.sleep(self.max_poll_interval)
+        
         print 'Unlocking objects...'
-        SuperTagProcessQueue.objects.filter(pk__in=objs_to_reset).update(locked=False)
-        transaction.commit()
-        print 'Done'
-        print 'Deleting processed objects from queue...'
-        SuperTagProcessQueue.objects.filter(pk__in=objs_to_del).delete()
+        SuperTagProcessQueue.objects.release(objs_to_reset)
         transaction.commit()
+        stop_commit_callbacks()
         print 'Done'
         print '%s of %s objects processed. %s failed.' % (processed, 
             processed + failed, failed)
+        return processed, failed
+    
+    def sleep(self, seconds):
+        """
+        Sleep, waking up early when asked to stop.
+        """
+        end = time.time() + seconds
+        while not _stop.is_set() and time.time() < end:
+            time.sleep(min(1, end - time.time()))
+    
+    def commit(self, unprocessed=()):
+        """
+        Remove the processed objects from the queue and commit their tags. 
+        Returns False if the commit failed, in which case the work since 
+        the last commit is rolled back and the processed objects are 
+        handed back, along with the ``unprocessed`` rest of the batch.
+        """
+        print 'Committing %s object(s)...' % len(self.objs_to_del)
+        objs_to_del = self.objs_to_del
+        self.objs_to_del, self.last_commit = [], time.time()
+        try:
+            SuperTagProcessQueue.objects.filter(pk__in=objs_to_del).delete()
+            transaction.commit()
+        except Exception, e:
+            print 'Failed to commit, rolling back... %s' % e
+            self.hand_back(objs_to_del + list(unprocessed))
+            return False
+        run_commit_callbacks()
+        print 'Done'
+        return True
+    
+    def hand_back(self, pks):
+        """
+        Roll back the work since the last commit and hand ``pks`` back to 
+        the queue without counting the attempt. If the database can't be 
+        reached, they are claimed again once their lease expires.
+        """
+        discard_commit_callbacks()
+        try:
+            transaction.rollback()
+            SuperTagProcessQueue.objects.release(pks, attempted=False)
+            transaction.commit()
+        except Exception, e:
+            print 'Failed to hand back %s object(s). %s' % (len(pks), e)
+            # Start over with a new connection
+            connection.close()
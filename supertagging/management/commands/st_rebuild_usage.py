@@ -0,0 +1,26 @@
+#!/usr/bin/python
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.contrib.contenttypes.models import ContentType
+
+from supertagging.models import SuperTagUsage
+
+class Command(BaseCommand):
+    help = ("Count the tagged items of every tag again, replacing the usage "
+            "counts read by usage_for_model and cloud_for_model.")
+    option_list = BaseCommand.option_list + (
+        make_option('--model', dest='model', default=None,
+            help='Only count the tagged items of this app_label.model_name.'),
+    )
+
+    @transaction.commit_on_success
+    def handle(self, *args, **kwargs):
+        ctype, usage = None, SuperTagUsage.objects.all()
+        if kwargs['model']:
+            app_label, model_name = kwargs['model'].split('.')
+            ctype = ContentType.objects.get(app_label=app_label, model=model_name)
+            usage = usage.filter(content_type=ctype)
+        SuperTagUsage.objects.rebuild(ctype)
+        print 'Done. %s tag usage count(s) rebuilt.' % usage.count()
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+from optparse import make_option
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, connection
+from django.db.models import Q
+from django.contrib.contenttypes.models import ContentType
+
+from supertagging.models import SuperTagContentFingerprint
+from supertagging.modules import process
+from supertagging.stores import get_response_store
+from supertagging.utils import (start_commit_callbacks, stop_commit_callbacks,
+    run_commit_callbacks)
+
+class Command(BaseCommand):
+    help = ("Rebuild the tagged items of every processed object from the "
+            "stored Calais responses, without calling Calais.")
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+            help='Number of worker processes.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=500, help='Number of objects handed to a worker at once.'),
+        make_option('--model', dest='model', default=None,
+            help='Only reprocess objects of this app_label.model_name.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        if get_response_store() is None:
+            raise CommandError("SUPERTAGGING_SETTINGS['RESPONSE_STORE']"
+                "['BACKEND'] must be set to reprocess stored responses.")
+        c = Core(kwargs['workers'], kwargs['batch_size'], kwargs['model'])
+        c.execute()
+
+
+def _init_worker():
+    # Each worker needs its own database connection, not the parent's.
+    connection.close()
+
+def reprocess_batch(batch):
+    """
+    Reprocess the objects of one content type from the response store.
+    """
+    start_commit_callbacks()
+    try:
+        processed = _reprocess_batch(batch)
+        run_commit_callbacks()
+    finally:
+        # Callbacks of a rolled back transaction are dropped
+        stop_commit_callbacks()
+    return processed
+
+@transaction.commit_on_success
+def _reprocess_batch(batch):
+    ctype_id, object_ids = batch
+    model = ContentType.objects.get_for_id(ctype_id).model_class()
+    processed = 0
+    for obj in model._base_manager.in_bulk(object_ids).values():
+        process(obj, offline=True)
+        processed += 1
+    return processed
+
+
+class Core(object):
+    """
+    Walks the processed objects and reprocesses them, in parallel when 
+    more than one worker is used. Objects are found by their fingerprints, 
+    which are recorded while a response store is configured.
+    """
+    def __init__(self, workers=1, batch_size=500, model=None):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.model = model
+
+    def get_batches(self):
+        """
+        Yield (content type id, object ids) batches, walking the processed 
+        objects in (content type, object id) order. An object has a 
+        fingerprint per field but is only handed to one batch.
+        """
+        queryset = SuperTagContentFingerprint.objects.all()
+        if self.model:
+            app_label, model_name = self.model.split('.')
+            queryset = queryset.filter(content_type__app_label=app_label,
+                content_type__model=model_name)
+        last_ctype, last_object = 0, 0
+        while True:
+            rows = list(queryset.filter(Q(content_type__gt=last_ctype) | 
+                Q(content_type=last_ctype, object_id__gt=last_object)
+                ).order_by('content_type', 'object_id').values_list(
+                    'content_type', 'object_id').distinct()[:self.batch_size])
+            if not rows:
+                break
+            batches = {}
+            for ctype_id, object_id in rows:
+                batches.setdefault(ctype_id, []).append(object_id)
+            last_ctype, last_object = rows[-1]
+            for ctype_id, object_ids in batches.items():
+                yield ctype_id, object_ids
+
+    def execute(self):
+        print 'Reprocessing objects from stored responses...'
+        processed = 0
+        if self.workers > 1:
+            connection.close()
+            pool = Pool(self.workers, _init_worker)
+            try:
+                for count in pool.imap_unordered(reprocess_batch, self.get_batches()):
+                    processed += count
+                    print '%s object(s) processed' % processed
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for batch in self.get_batches():
+                processed += reprocess_batch(batch)
+                print '%s object(s) processed' % processed
+        print 'Done. %s object(s) reprocessed.' % processed
@@ -0,0 +1,108 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'SuperTagContentFingerprint'
+        db.create_table('supertagging_supertagcontentfingerprint', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('content_type', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['contenttypes.ContentType'])),
+            ('object_id', self.gf('django.db.models.fields.PositiveIntegerField')()),
+            ('field', self.gf('django.db.models.fields.CharField')(max_length=100)),
+            ('fingerprint', self.gf('django.db.models.fields.CharField')(max_length=40)),
+            ('date_processed', self.gf('django.db.models.fields.DateTimeField')(auto_now=True, blank=True)),
+        ))
+        db.send_create_signal('supertagging', ['SuperTagContentFingerprint'])
+
+        # Adding unique constraint on 'SuperTagContentFingerprint', fields ['content_type', 'object_id', 'field']
+        db.create_unique('supertagging_supertagcontentfingerprint', ['content_type_id', 'object_id', 'field'])
+
+
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'SuperTagContentFingerprint', fields ['content_type', 'object_id', 'field']
+        db.delete_unique('supertagging_supertagcontentfingerprint', ['content_type_id', 'object_id', 'field'])
+
+        # Deleting model 'SuperTagContentFingerprint'
+        db.delete_table('supertagging_supertagcontentfingerprint')
+
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'supertagging.supertag': {
+            'Meta': {'ordering': "('name',)", 'object_name': 'SuperTag'},
+            'calais_id': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'description': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'display_name': ('django.db.models.fields.CharField', [], {'max_length': '150', 'null': 'True', 'blank': 'True'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'icon': ('django.db.models.fields.files.ImageField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '150'}),
+            'properties': ('supertagging.fields.PickledObjectField', [], {'null': 'True', 'blank': 'True'}),
+            'related': ('django.db.models.fields.related.ManyToManyField', [], {'blank': 'True', 'related_name': "'related_rel_+'", 'null': 'True', 'to': "orm['supertagging.SuperTag']"}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '150'}),
+            'stype': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'substitute': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'substitute_tagsubstitute'", 'null': 'True', 'to': "orm['supertagging.SuperTag']"})
+        },
+        'supertagging.supertagcontentfingerprint': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'field'),)", 'object_name': 'SuperTagContentFingerprint'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'date_processed': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'field': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'fingerprint': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {})
+        },
+        'supertagging.supertaggeditem': {
+            'Meta': {'ordering': "('-relevance',)", 'object_name': 'SuperTaggedItem'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'field': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'ignore': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'instances': ('supertagging.fields.PickledObjectField', [], {'null': 'True', 'blank': 'True'}),
+            'item_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'process_type': ('django.db.models.fields.CharField', [], {'max_length': '20', 'null': 'True', 'blank': 'True'}),
+            'relevance': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['supertagging.SuperTag']"})
+        },
+        'supertagging.supertaggedrelationitem': {
+            'Meta': {'ordering': "['-item_date']", 'object_name': 'SuperTaggedRelationItem'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'field': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'instances': ('supertagging.fields.PickledObjectField', [], {'null': 'True', 'blank': 'True'}),
+            'item_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'process_type': ('django.db.models.fields.CharField', [], {'max_length': '20', 'null': 'True', 'blank': 'True'}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['supertagging.SuperTagRelation']"})
+        },
+        'supertagging.supertagprocessqueue': {
+            'Meta': {'object_name': 'SuperTagProcessQueue'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'locked': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {})
+        },
+        'supertagging.supertagrelation': {
+            'Meta': {'object_name': 'SuperTagRelation'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '150'}),
+            'properties': ('supertagging.fields.PickledObjectField', [], {'null': 'True', 'blank': 'True'}),
+            'stype': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['supertagging.SuperTag']"})
+        }
+    }
+
+    complete_apps = ['supertagging']
@@ -1,19 +1,32 @@
-from django.db import models, connection
+import datetime, time
+
+from django.db import models, connection, transaction, IntegrityError
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.template.defaultfilters import slugify
-from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_delete, post_delete
 from django.utils.translation import ugettext as _
+from django.utils.encoding import force_unicode
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 
 from supertagging.handlers import setup_handlers
 from supertagging.fields import PickledObjectField
 from supertagging.utils import (calculate_cloud, get_tag_list, 
                             get_queryset_and_model, LOGARITHMIC, render_item, 
-                            retrieve_freebase_name, retrieve_freebase_desc)
+                            retrieve_freebase_name, retrieve_freebase_desc,
+                            LRUCache, normalize_tag_name, on_commit)
 from supertagging import settings as st_settings
 
 qn = connection.ops.quote_name
 
+# Tags resolved while processing, kept for the life of the process. Keys
+# are ('name', normalized name, type) or ('calais', calais id) and values
+# are the tag to use, after substitution. Set with ``cache_tag`` and
+# emptied by ``check_tag_cache`` when tags change in another process.
+tag_cache = LRUCache(st_settings.TAG_CACHE_SIZE)
+
 ###################
 ##   MANAGERS    ##
 ###################
@@ -38,7 +51,7 @@ class SuperTagManager(models.Manager):
         try:
             # Try to retrieve the existing name given by freebase 
             # in our database
-            new_tag = self.get(name__iexact=fb_name)
+            new_tag = self.get(normalized_name=normalize_tag_name(fb_name))
             # Return the new tag or the new tags substitute
             return new_tag.substitute or new_tag
         except:
@@ -60,7 +73,7 @@ class SuperTagManager(models.Manager):
             
         fb_name = retrieve_freebase_name(name, stype)
         try:
-            new_tag = self.get(name__iexact=fb_name)
+            new_tag = self.get(normalized_name=normalize_tag_name(fb_name))
             return new_tag.substitute or new_tag
         except:
             kwargs["name"] = fb_name.lower()
@@ -115,6 +128,7 @@ class SuperTagManager(models.Manager):
                ON %(tagged_item)s.object_id = %(model_pk)s
            %%s
         WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
+           AND %(tagged_item)s.%(ignore)s = %%%%s
            %%s 
         GROUP BY %(tag)s.id, %(tag)s.name, %(tag)s.slug
         %%s
@@ -125,7 +139,10 @@ class SuperTagManager(models.Manager):
             'model': model_table,
             'model_pk': model_pk,
             'content_type_id': ContentType.objects.get_for_model(model).pk,
+            'ignore': qn('ignore'),
         }
+        # Ignored items are not counted, as in SuperTagUsage
+        params = [False] + list(params)
         
         min_count_sql = ''
         if min_count is not None:
@@ -142,6 +159,27 @@ class SuperTagManager(models.Manager):
             tags.append(t)
         return tags
     
+    def _get_counted_usage(self, model, counts=False, min_count=None):
+        """
+        Read the usage of every instance of ``model`` from the counts kept 
+        in ``SuperTagUsage``, instead of counting the tagged items.
+        """
+        if min_count is not None: 
+            counts = True
+        
+        usage = SuperTagUsage.objects.filter(count__gt=0,
+            content_type=ContentType.objects.get_for_model(model))
+        if min_count is not None:
+            usage = usage.filter(count__gte=min_count)
+        tags = []
+        for tag_id, name, slug, count in usage.order_by('tag__name').values_list(
+            'tag', 'tag__name', 'tag__slug', 'count'):
+            t = self.model(id=tag_id, name=name, slug=slug)
+            if counts:
+                t.count = count
+            tags.append(t)
+        return tags
+    
     def usage_for_model(self, model, counts=False, min_count=None, filters=None):
         """
         Obtain a list of tags associated with instances of the given
@@ -182,6 +220,9 @@ class SuperTagManager(models.Manager):
         If ``min_count`` is given, only tags which have a ``count``
         greater than or equal to ``min_count`` will be returned.
         Passing a value for ``min_count`` implies ``counts=True``.
+        
+        When the queryset is not filtered, the counts are read from 
+        ``SuperTagUsage`` without a query over the tagged items.
         """
         
         if getattr(queryset.query, 'get_compiler', None):
@@ -197,6 +238,9 @@ class SuperTagManager(models.Manager):
         # extra_joins = ' '.join(
         #  queryset.query.get_compiler(using='default').get_from_clause()[0][1:])
         # where, params = queryset.query.where.as_sql()
+        if not (where or extra_joins.strip()):
+            # Every instance, the counts are already kept
+            return self._get_counted_usage(queryset.model, counts, min_count)
         if where:
             extra_criteria = 'AND %s' % where
         else:
@@ -284,6 +328,35 @@ class SuperTaggedItemManager(models.Manager):
             params=[content_type.pk, tag.pk],
         )
     
+    def _filter_by_tags(self, queryset, model, tags, match_all):
+        """
+        Filter ``queryset`` on the objects tagged with any, or all if 
+        ``match_all``, of ``tags``. The tagged items are matched in a 
+        subquery, so the queryset stays lazy and the object ids are never 
+        fetched.
+        """
+        query = """
+        %(model_pk)s IN (
+            SELECT %(tagged_item)s.object_id
+            FROM %(tagged_item)s
+            WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
+              AND %(tagged_item)s.tag_id IN (%(tag_id_placeholders)s)"""
+        if match_all:
+            # An object can have a tag in several fields, count it once
+            query += """
+            GROUP BY %(tagged_item)s.object_id
+            HAVING COUNT(DISTINCT %(tagged_item)s.tag_id) = %(tag_count)s"""
+        query += ")"
+        tag_ids = [tag.pk for tag in tags]
+        query = query % {
+            'model_pk': '%s.%s' % (qn(model._meta.db_table), qn(model._meta.pk.column)),
+            'tagged_item': qn(self.model._meta.db_table),
+            'content_type_id': ContentType.objects.get_for_model(model).pk,
+            'tag_id_placeholders': ','.join(['%s'] * len(tag_ids)),
+            'tag_count': len(tag_ids),
+        }
+        return queryset.extra(where=[query], params=tag_ids)
+    
     def get_intersection_by_model(self, queryset_or_model, tags):
         """
         Create a ``QuerySet`` containing instances of the specified
@@ -296,32 +369,7 @@ class SuperTaggedItemManager(models.Manager):
         if not tag_count:
             return model._default_manager.none()
         
-        model_table = qn(model._meta.db_table)
-        # This query selects the ids of all objects which have all the
-        # given tags.
-        query = """
-        SELECT %(model_pk)s
-        FROM %(model)s, %(tagged_item)s
-        WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
-          AND %(tagged_item)s.tag_id IN (%(tag_id_placeholders)s)
-          AND %(model_pk)s = %(tagged_item)s.object_id
-        GROUP BY %(model_pk)s
-        HAVING COUNT(%(model_pk)s) = %(tag_count)s""" % {
-            'model_pk': '%s.%s' % (model_table, qn(model._meta.pk.column)),
-            'model': model_table,
-            'tagged_item': qn(self.model._meta.db_table),
-            'content_type_id': ContentType.objects.get_for_model(model).pk,
-            'tag_id_placeholders': ','.join(['%s'] * tag_count),
-            'tag_count': tag_count,
-        }
-        
-        cursor = connection.cursor()
-        cursor.execute(query, [tag.pk for tag in tags])
-        object_ids = [row[0] for row in cursor.fetchall()]
-        if len(object_ids) > 0:
-            return queryset.filter(pk__in=object_ids)
-        else:
-            return model._default_manager.none()
+        return self._filter_by_tags(queryset, model, tags, match_all=True)
     
     def get_union_by_model(self, queryset_or_model, tags):
         """
@@ -335,30 +383,7 @@ class SuperTaggedItemManager(models.Manager):
         if not tag_count:
             return model._default_manager.none()
 
-        model_table = qn(model._meta.db_table)
-        # This query selects the ids of all objects which have any of
-        # the given tags.
-        query = """
-        SELECT %(model_pk)s
-        FROM %(model)s, %(tagged_item)s
-        WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
-          AND %(tagged_item)s.tag_id IN (%(tag_id_placeholders)s)
-          AND %(model_pk)s = %(tagged_item)s.object_id
-        GROUP BY %(model_pk)s""" % {
-            'model_pk': '%s.%s' % (model_table, qn(model._meta.pk.column)),
-            'model': model_table,
-            'tagged_item': qn(self.model._meta.db_table),
-            'content_type_id': ContentType.objects.get_for_model(model).pk,
-            'tag_id_placeholders': ','.join(['%s'] * tag_count),
-        }
-
-        cursor = connection.cursor()
-        cursor.execute(query, [tag.pk for tag in tags])
-        object_ids = [row[0] for row in cursor.fetchall()]
-        if len(object_ids) > 0:
-            return queryset.filter(pk__in=object_ids)
-        else:
-            return model._default_manager.none()
+        return self._filter_by_tags(queryset, model, tags, match_all=False)
 
     def get_related(self, obj, queryset_or_model, min_relevance=0, num=None):
         """
@@ -447,6 +472,10 @@ class SuperTag(models.Model):
         help_text=_("""Tag to use instead of this one. This will also update
             all items and relation items from this tag to the substitute tag."""))
     name = models.CharField(_("Name"), max_length=150)
+    # The name as compared when resolving tags, see normalize_tag_name. 
+    # Indexed with stype by migration 0009.
+    normalized_name = models.CharField(_("Normalized Name"), max_length=150, 
+        editable=False)
     slug = models.SlugField(_("Slug"), max_length=150)
     stype = models.CharField(_("Type"), max_length=100)
     properties = PickledObjectField(_("Properties"), null=True, blank=True)
@@ -472,9 +501,21 @@ class SuperTag(models.Model):
 
     objects = SuperTagManager()
 
+    def __init__(self, *args, **kwargs):
+        super(SuperTag, self).__init__(*args, **kwargs)
+        self._resolution_state = self._get_resolution_state()
+
     def __unicode__(self):
         return "%s - %s" % (self.name, self.stype)
         
+    def _get_resolution_state(self):
+        """
+        The values that decide which tag a Calais entity resolves to.
+        """
+        # Read from __dict__ so deferred fields are not loaded
+        return tuple([self.__dict__.get(f) for f in ('id', 'calais_id', 
+            'name', 'stype', 'substitute_id', 'enabled')])
+        
     def get_name(self):
         if self.has_display_fields():
             return self.display_name or self.name
@@ -494,7 +535,16 @@ class SuperTag(models.Model):
         ordering = ('name',)
         
     def save(self, *args, **kwargs):      
+        self.normalized_name = normalize_tag_name(self.name)
         super(SuperTag, self).save(*args, **kwargs)
+        # Forget cached resolutions if this tag was renamed, substituted 
+        # or disabled. Saving new properties leaves the cache alone.
+        state = self._get_resolution_state()
+        if state != self._resolution_state:
+            if self._resolution_state[0] is not None:
+                invalidate_tag_cache(self, self._resolution_state)
+            self._resolution_state = state
+        
         # If display fields are available and FREEBASE_RETRIEVE_DESCRIPTIONS is True
         # and the description field is empty, try to get a description from Freebase
         if self.has_display_fields() and st_settings.FREEBASE_RETRIEVE_DESCRIPTIONS and not self.description:
@@ -505,6 +555,8 @@ class SuperTag(models.Model):
         if not self.enabled and st_settings.REMOVE_REL_ON_DISABLE:
             SuperTaggedItem.objects.filter(tag__pk=self.pk).delete()
             SuperTaggedRelationItem.objects.filter(relation__tag__pk=self.pk).delete()
+            SuperTagUsage.objects.delete_counts(
+                SuperTagUsage.objects.filter(tag__pk=self.pk))
             
         # If a substitute is supplied, change all SuperTaggedItem's and 
         # SuperTagRelation's to have this new tag
@@ -513,6 +565,12 @@ class SuperTag(models.Model):
             relations = self.supertagrelation_set.all()  
             items.update(tag=self.substitute)
             relations.update(tag=self.substitute)
+            # The substitute is now used where this tag was
+            usage = SuperTagUsage.objects.filter(tag__pk=self.pk)
+            SuperTagUsage.objects.adjust(dict([
+                ((self.substitute.pk, ctype_id), count) for ctype_id, count 
+                in usage.values_list('content_type', 'count')]))
+            SuperTagUsage.objects.delete_counts(usage)
 
 
 class SuperTagRelation(models.Model):
@@ -549,9 +607,21 @@ class SuperTaggedItem(models.Model):
     class Meta:
         ordering = ('-relevance',)
     
+    def __init__(self, *args, **kwargs):
+        super(SuperTaggedItem, self).__init__(*args, **kwargs)
+        self._was_ignored = self.pk and self.__dict__.get('ignore')
+    
     def __unicode__(self):
         return u'%s of %s' % (self.tag, unicode(self.content_object))
     
+    def save(self, *args, **kwargs):
+        super(SuperTaggedItem, self).save(*args, **kwargs)
+        # Ignoring an item, or no longer ignoring it, changes the usage
+        if self._was_ignored is not None and self.ignore != self._was_ignored:
+            SuperTagUsage.objects.adjust({
+                (self.tag_id, self.content_type_id): self.ignore and -1 or 1})
+        self._was_ignored = self.ignore
+    
     def render(self, template=None, suffix=None):
         return render_item(self, None, template, suffix,
             template_path="supertagging/render/tagged_items", 
@@ -581,11 +651,86 @@ class SuperTaggedRelationItem(models.Model):
             template_path="supertagging/render/tagged_relations",
             context={'obj': self.content_object, 'content': self})
 
+class SuperTagProcessQueueManager(models.Manager):
+    def claimable(self):
+        """
+        Items that are unlocked, or whose lease has expired because the 
+        worker that claimed them died. Items locked by hand have no 
+        ``claimed_at`` and are never reclaimed.
+        """
+        expired = datetime.datetime.now() - datetime.timedelta(
+            seconds=st_settings.QUEUE_LEASE_TIMEOUT)
+        return self.filter(models.Q(locked=False) | models.Q(locked=True, 
+            claimed_at__lt=expired), failed=False)
+    
+    def claim(self, token, batch_size):
+        """
+        Lock up to ``batch_size`` claimable items for the worker identified 
+        by ``token`` and return them. The UPDATE only matches items that 
+        are still claimable, so concurrent workers never claim the same item.
+        """
+        # Items that used up their attempts without reporting back, most 
+        # likely by crashing the worker, are not tried again.
+        self.claimable().filter(locked=True, 
+            attempts__gte=st_settings.QUEUE_MAX_ATTEMPTS).update(
+            locked=False, failed=True, claim_token='', claimed_at=None, 
+            last_error='Lease expired')
+        # Items of dead workers first, they have waited the longest. Then 
+        # the highest priority, oldest items, walking the index on 
+        # (failed, locked, priority DESC, enqueued_at). Nothing is added to 
+        # the ordering, or the database would have to sort the items.
+        ordering = ('-priority', 'enqueued_at')
+        expired = datetime.datetime.now() - datetime.timedelta(
+            seconds=st_settings.QUEUE_LEASE_TIMEOUT)
+        pks = list(self.filter(failed=False, locked=True, 
+            claimed_at__lt=expired).order_by(*ordering).values_list(
+            'pk', flat=True)[:batch_size])
+        if len(pks) < batch_size:
+            pks.extend(self.filter(failed=False, locked=False).order_by(
+                *ordering).values_list('pk', flat=True)[:batch_size - len(pks)])
+        if not pks:
+            return []
+        self.claimable().filter(pk__in=pks).update(locked=True, 
+            claim_token=token, claimed_at=datetime.datetime.now(), 
+            attempts=models.F('attempts') + 1)
+        return list(self.filter(pk__in=pks, claim_token=token).order_by(*ordering))
+    
+    def release(self, pks, attempted=True):
+        """
+        Unlock items so they can be claimed again. If they were not 
+        ``attempted``, their claim doesn't count as an attempt.
+        """
+        kwargs = {}
+        if not attempted:
+            kwargs['attempts'] = models.F('attempts') - 1
+        self.filter(pk__in=pks, failed=False).update(locked=False, 
+            claim_token='', claimed_at=None, **kwargs)
+    
+    def record_failure(self, item, error):
+        """
+        Save the error of a failed attempt, marking the item as failed when 
+        it has used up its attempts.
+        """
+        failed = item.attempts >= st_settings.QUEUE_MAX_ATTEMPTS
+        kwargs = {'last_error': force_unicode(error), 'failed': failed}
+        if failed:
+            kwargs.update(locked=False, claim_token='', claimed_at=None)
+        self.filter(pk=item.pk).update(**kwargs)
+
 class SuperTagProcessQueue(models.Model):
     content_type = models.ForeignKey(ContentType)
     object_id = models.PositiveIntegerField()
     content_object = generic.GenericForeignKey('content_type', 'object_id')
     locked = models.BooleanField(default=False)
+    claim_token = models.CharField(max_length=32, blank=True, db_index=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    failed = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True)
+    priority = models.IntegerField(default=0)
+    enqueued_at = models.DateTimeField(default=datetime.datetime.now)
+    
+    objects = SuperTagProcessQueueManager()
     
     def __unicode__(self):
         return 'Queue Item: <%s> %s' % (
@@ -596,16 +741,228 @@ class SuperTagProcessQueue(models.Model):
         verbose_name = "Process Queue"
         verbose_name_plural = "Process Queue"
 
+class SuperTagContentFingerprint(models.Model):
+    """
+    A hash of the text last sent to Calais for a field of an object, used 
+    to skip processing when the text has not changed.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    field = models.CharField(max_length=100)
+    fingerprint = models.CharField(max_length=40)
+    date_processed = models.DateTimeField(auto_now=True)
+    
+    def __unicode__(self):
+        return u'%s of %s' % (self.field, unicode(self.content_object))
+    
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'field'),)
+        verbose_name = "Content Fingerprint"
+
+class SuperTagCalaisResponse(models.Model):
+    """
+    A compressed, raw response from Calais, stored by the fingerprint of 
+    the text that was sent. Used by ``DatabaseResponseStore``.
+    """
+    fingerprint = models.CharField(max_length=40, unique=True)
+    data = models.TextField()
+    date_created = models.DateTimeField(auto_now_add=True)
+    
+    def __unicode__(self):
+        return self.fingerprint
+    
+    class Meta:
+        verbose_name = "Calais Response"
+
+class SuperTagUsageManager(models.Manager):
+    def adjust(self, changes):
+        """
+        Add to the counts. ``changes`` is a dict of 
+        {(tag id, content type id): number of items added or removed}.
+        """
+        changed = set()
+        for (tag_id, ctype_id), delta in changes.items():
+            if not delta:
+                continue
+            changed.add(ctype_id)
+            usage = self.filter(tag=tag_id, content_type=ctype_id)
+            if usage.update(count=models.F('count') + delta) or delta < 0:
+                continue
+            sid = transaction.savepoint()
+            try:
+                self.create(tag_id=tag_id, content_type_id=ctype_id, count=delta)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Another worker counted the tag in the meantime
+                transaction.savepoint_rollback(sid)
+                usage.update(count=models.F('count') + delta)
+        for ctype_id in changed:
+            invalidate_usage_cache(ctype_id)
+    
+    def record(self, added=(), removed=()):
+        """
+        Count the tagged items ``added`` and no longer count the ``removed`` 
+        ones. Ignored items are not counted.
+        """
+        changes = {}
+        for items, delta in ((added, 1), (removed, -1)):
+            for item in items:
+                if not item.ignore:
+                    key = (item.tag_id, item.content_type_id)
+                    changes[key] = changes.get(key, 0) + delta
+        self.adjust(changes)
+    
+    def rebuild(self, content_type=None):
+        """
+        Count the tagged items again, for one content type or all of them.
+        """
+        usage, items = self.all(), SuperTaggedItem.objects.filter(ignore=False)
+        if content_type is not None:
+            usage = usage.filter(content_type=content_type)
+            items = items.filter(content_type=content_type)
+        self.delete_counts(usage)
+        counts = items.values_list('tag', 'content_type').annotate(
+            count=models.Count('pk')).order_by()
+        self.bulk_create([SuperTagUsage(tag_id=tag_id, content_type_id=ctype_id, 
+            count=count) for tag_id, ctype_id, count in counts])
+        for ctype_id in set([ctype_id for tag_id, ctype_id, count in counts]):
+            invalidate_usage_cache(ctype_id)
+    
+    def delete_counts(self, usage):
+        """
+        Delete the counts in the ``usage`` queryset, invalidating the 
+        cached usage of their content types.
+        """
+        for ctype_id in set(usage.values_list('content_type', flat=True)):
+            invalidate_usage_cache(ctype_id)
+        usage.delete()
+
+class SuperTagUsage(models.Model):
+    """
+    The number of tagged items, ignored items aside, of a tag for a 
+    content type. Kept up to date as objects are processed so the usage 
+    of a model is read without counting its tagged items.
+    """
+    tag = models.ForeignKey(SuperTag)
+    content_type = models.ForeignKey(ContentType)
+    count = models.IntegerField(default=0)
+    
+    objects = SuperTagUsageManager()
+    
+    def __unicode__(self):
+        return u'%s of %s' % (self.tag, self.content_type)
+    
+    class Meta:
+        unique_together = (('content_type', 'tag'),)
+        verbose_name = "Tag Usage"
+
+USAGE_GENERATION_KEY = 'ST_USAGE_GENERATION.%s'
+TAG_GENERATION_KEY = 'ST_TAG_GENERATION'
+
+def _get_generation(key):
+    # Start from the time so a counter that was evicted doesn't go back 
+    # to a number used before
+    cache.add(key, int(time.time() * 1000), 60 * 60 * 24 * 30)
+    return cache.get(key)
+
+def _bump_generation(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Not set yet, or evicted
+        cache.set(key, int(time.time() * 1000), 60 * 60 * 24 * 30)
+
+def get_usage_generation(content_type_id):
+    """
+    A number that changes whenever the tag usage of a content type does, 
+    to put in the keys of cached usage. Cached usage is then invalidated 
+    by changing this number instead of finding and deleting every key.
+    """
+    return _get_generation(USAGE_GENERATION_KEY % content_type_id)
+
+def invalidate_usage_cache(content_type_id):
+    """
+    Invalidate the cached tag usage of a content type once the current 
+    transaction is committed, so the usage isn't cached again from the 
+    counts before they change. Invalidated straight away if the commit 
+    can't be waited for.
+    """
+    key = USAGE_GENERATION_KEY % content_type_id
+    bump = lambda: _bump_generation(key)
+    if not on_commit(bump, key):
+        bump()
+
+def cache_tag(keys, tag):
+    """
+    Keep ``tag`` in ``tag_cache`` under each of ``keys`` once the current 
+    transaction is committed, so a rollback can't leave a cached tag that 
+    doesn't exist.
+    """
+    def set_tag():
+        for key in keys:
+            tag_cache.set(key, tag)
+    on_commit(set_tag)
+
+_tag_cache_generation = None
+
+def _cache_is_shared():
+    """
+    Whether other processes see what this one puts in Django's cache.
+    """
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+def check_tag_cache():
+    """
+    Empty ``tag_cache`` if a tag was renamed, substituted, disabled or 
+    deleted by any process sharing the cache since the last check. When 
+    Django's cache isn't shared, those changes can't be seen, so the tag 
+    cache is always emptied and only spares lookups within one object.
+    """
+    global _tag_cache_generation
+    if not _cache_is_shared():
+        tag_cache.clear()
+        return
+    generation = _get_generation(TAG_GENERATION_KEY)
+    if generation != _tag_cache_generation:
+        tag_cache.clear()
+        _tag_cache_generation = generation
+
+def invalidate_tag_cache(tag, old_state=None):
+    """
+    Remove every cached resolution that was looked up by ``tag``'s name 
+    or Calais ID, or that resolved to ``tag``. ``old_state`` is the 
+    tag's previous resolution state, so a renamed tag's old name is 
+    dropped as well. Other processes empty their cache once the change 
+    is committed.
+    """
+    keys = set([normalize_tag_name(tag.name), tag.calais_id])
+    if old_state:
+        keys.add(old_state[1])
+        keys.add(normalize_tag_name(old_state[2] or ''))
+    tag_cache.delete_matching(
+        lambda key, value: key[1] in keys or value.pk == tag.pk)
+    bump = lambda: _bump_generation(TAG_GENERATION_KEY)
+    if not on_commit(bump, TAG_GENERATION_KEY):
+        bump()
+
+def _invalidate_deleted_tag(sender, instance, **kwargs):
+    if instance:
+        invalidate_tag_cache(instance)
+
+post_delete.connect(_invalidate_deleted_tag, sender=SuperTag)
+
 def _clean_tagged_relation_items(sender, instance, **kwargs):
     if not instance:
         return
         
     items = SuperTaggedRelationItem.objects.filter(
-        relation__tag__pk=instance.tag.pk,
-        content_type__pk=instance.content_type.pk,
-        object_id=instance.object_id).delete()
+        relation__tag__pk=instance.tag_id,
+        content_type__pk=instance.content_type_id,
+        object_id=instance.object_id, field=instance.field).delete()
 
-# When a tagged item is removed, clean up the related tagged items as well.
+# When a tagged item is removed, clean up the related tagged items of the 
+# same field as well.
 pre_delete.connect(_clean_tagged_relation_items, sender=SuperTaggedItem)
 
 # Setup the post save and post delete signals
@@ -1,42 +1,107 @@
 """
 Django-SuperTagging
 """
-import re, datetime
+import os, re, datetime
 from django.contrib.contenttypes.models import ContentType
 from django.template.defaultfilters import slugify
 from django.utils.encoding import force_unicode
 from django.db.models.loading import get_model
+from django.db import transaction, IntegrityError
+from django.core.cache import cache
 
 from supertagging import settings
-from supertagging.calais import Calais
+from supertagging.calais import Calais, CalaisResponse, CalaisQuotaExceeded, CircuitOpen
+from supertagging.calais import get_connection_pool, get_rate_limiter, get_circuit_breaker
 from supertagging.models import SuperTag, SuperTagRelation, SuperTaggedItem, SuperTaggedRelationItem, SuperTagProcessQueue
+from supertagging.models import SuperTagContentFingerprint, SuperTagUsage, tag_cache
+from supertagging.models import cache_tag, check_tag_cache
 from supertagging.markup import invalidate_markup_cache
+from supertagging.stores import get_response_store
+from supertagging.utils import normalize_tag_name, on_commit, LRUCache
 
 REF_REGEX = "^http://d.opencalais.com/(?P<key>.*)$"
 
-def add_to_queue(instance):
+QUEUE_CHUNK_SIZE = 500
+
+# The properties last written for each tag id, see _update_tag_properties
+_tag_properties = LRUCache(settings.TAG_CACHE_SIZE)
+
+def add_to_queue(instance, priority=None):
     """
     Add object to the queue.
+    
+    Objects with a higher ``priority`` are processed first. It defaults to 
+    the model's ``priority`` in MODULES, or 0. Adding an object that is 
+    already waiting raises its priority if the new one is higher. An 
+    object that used up its attempts is tried again.
     """
-    # Only add the queue if supplied match_kwargs returns the instance
-    params = settings.MODULES.get('%s.%s' % (instance._meta.app_label, 
-            instance._meta.module_name), {})
-    if 'match_kwargs' in params:
-        model = get_model(instance._meta.app_label, instance._meta.module_name)
-        try:
-            # Make sure this obj matches the match kwargs
-            instance = model.objects.get(pk=instance.pk, **params['match_kwargs'])
-        except model.DoesNotExist:
-            return
+    add_many_to_queue([instance], priority)
+
+def add_many_to_queue(objects, priority=None):
+    """
+    Add a queryset or a list of objects to the queue, a few queries for 
+    every QUEUE_CHUNK_SIZE objects instead of several per object. Takes 
+    the same ``priority`` as ``add_to_queue``. Returns the number of 
+    objects added.
+    """
+    # Group the primary keys by model. A queryset is filtered by the 
+    # match_kwargs in the database and its objects are never loaded.
+    if hasattr(objects, 'values_list'):
+        models = {objects.model: objects}
+    else:
+        models = {}
+        for instance in objects:
+            models.setdefault(instance.__class__, []).append(instance.pk)
     
-    cont_type = ContentType.objects.get_for_model(instance)
-    # If ONLY_NON_TAGGED_OBJECTS is True and 'instance' has been 
-    # tagged, DO NOT add to queue
-    if settings.ONLY_NON_TAGGED_OBJECTS and SuperTaggedItem.objects.filter(
-        content_type__pk=cont_type.pk, object_id=str(instance.pk)).count() > 0:
-        return
-    SuperTagProcessQueue.objects.get_or_create(
-        content_type=cont_type, object_id=instance.pk)
+    added = 0
+    for model, pks in models.items():
+        params = settings.MODULES.get('%s.%s' % (model._meta.app_label, 
+                model._meta.module_name), {})
+        match_kwargs = params.get('match_kwargs')
+        if hasattr(pks, 'values_list'):
+            pks = pks.filter(**(match_kwargs or {})).values_list(
+                'pk', flat=True).iterator()
+            match_kwargs = None
+        model_priority = priority
+        if model_priority is None:
+            model_priority = params.get('priority', 0)
+        cont_type = ContentType.objects.get_for_model(model)
+        chunk = []
+        for pk in pks:
+            chunk.append(pk)
+            if len(chunk) == QUEUE_CHUNK_SIZE:
+                added += _add_chunk_to_queue(model, cont_type, chunk, 
+                    match_kwargs, model_priority)
+                chunk = []
+        if chunk:
+            added += _add_chunk_to_queue(model, cont_type, chunk, 
+                match_kwargs, model_priority)
+    return added
+
+def _add_chunk_to_queue(model, cont_type, pks, match_kwargs, priority):
+    pks = set(pks)
+    # Only add the objects the supplied match_kwargs return
+    if match_kwargs:
+        pks = set(model.objects.filter(pk__in=pks, 
+            **match_kwargs).values_list('pk', flat=True))
+    # If ONLY_NON_TAGGED_OBJECTS is True, DO NOT add tagged objects
+    if settings.ONLY_NON_TAGGED_OBJECTS and pks:
+        pks -= set(SuperTaggedItem.objects.filter(content_type=cont_type, 
+            object_id__in=pks).values_list('object_id', flat=True))
+    if not pks:
+        return 0
+    queued = SuperTagProcessQueue.objects.filter(content_type=cont_type, 
+        object_id__in=pks)
+    # Objects that used up their attempts are tried again from scratch
+    queued.filter(failed=True).update(failed=False, attempts=0, 
+        last_error='', locked=False, claim_token='', claimed_at=None)
+    # Objects already waiting keep their place, raising their priority
+    queued.filter(priority__lt=priority).update(priority=priority)
+    pks -= set(queued.values_list('object_id', flat=True))
+    _bulk_create(SuperTagProcessQueue, [SuperTagProcessQueue(
+        content_type=cont_type, object_id=pk, priority=priority) 
+        for pk in sorted(pks)])
+    return len(pks)
     
 def remove_from_queue(instance):
     """
@@ -48,19 +113,35 @@ def remove_from_queue(instance):
     except SuperTagProcessQueue.DoesNotExist:
         pass
 
-def process(obj, tags=[]):
+def process(obj, tags=[], force=False, offline=False, requests_per_second=None):
     """
     Process the data.
+    
+    Fields whose text has not changed since they were last processed are 
+    skipped when SKIP_UNCHANGED_CONTENT is on, unless ``force`` is True.
+    
+    Raises CalaisQuotaExceeded, without changing any tags, when the daily 
+    quota of Calais requests is used up, and CircuitOpen when Calais failed 
+    too many times in a row to be tried again yet.
+    
+    If ``offline`` is True, Calais is never called: every field is rebuilt 
+    from the response kept in the RESPONSE_STORE, and fields without a 
+    stored response are left alone.
+    
+    ``requests_per_second`` overrides the REQUESTS_PER_SECOND setting.
     """
     # In the case when we want to turn off ALL processing of data, while
     # preserving AUTO_PROCESS 
     if not settings.ENABLED:
         return
 
-    if not settings.API_KEY:
+    if not (settings.API_KEY or offline):
         if settings.ST_DEBUG:
             raise ValueError('Calais API KEY is missing.')
         return
+    
+    # Drop cached tags if tags were changed elsewhere
+    check_tag_cache()
 
     try:
         params = settings.MODULES['%s.%s' % (obj._meta.app_label, 
@@ -100,7 +181,12 @@ def process(obj, tags=[]):
     # Create the instance of Calais and setup the parameters,
     # see open-calais.com for more information about user directives,
     # and processing directives
-    c = Calais(settings.API_KEY)
+    c = Calais(settings.API_KEY, pool=get_connection_pool(
+            size=settings.OPEN_CALAIS['POOL_SIZE'],
+            timeout=settings.OPEN_CALAIS['TIMEOUT']), 
+        circuit_breaker=get_circuit_breaker(
+            settings.OPEN_CALAIS['FAILURE_THRESHOLD'],
+            settings.OPEN_CALAIS['FAILURE_COOLDOWN'], _record_circuit_state))
     c.user_directives.update(settings.USER_DIR)
     c.processing_directives.update(settings.PROCESSING_DIR)
     c.processing_directives['contentType'] = process_type
@@ -130,16 +216,30 @@ def process(obj, tags=[]):
         continue
         
     processed_tags = []
+    # The tagged items and relation items for every field, keyed by 
+    # (tag or relation id, field). They are merged in memory and compared 
+    # with the existing items once all fields are analyzed.
+    tagged_items, relation_items = {}, {}
+    # Fields that failed or were skipped keep their existing items.
+    keep_fields = []
     
-    # Remove existing items, this ensures tagged items 
-    # are updated correctly
-    SuperTaggedItem.objects.active().filter(content_type=ctype, 
-        object_id=obj.pk).delete()
-    if settings.PROCESS_RELATIONS:
-        SuperTaggedRelationItem.objects.filter(content_type=ctype, 
-            object_id=obj.pk).delete()
+    # Fingerprints of the text last sent for each field. Only complete 
+    # runs record them, so processing a subset of ``tags`` never skips. 
+    # They are also recorded when responses are stored, for st_reprocess.
+    skip_unchanged = settings.SKIP_UNCHANGED_CONTENT and not tags
+    force = force or offline
+    store = get_response_store()
+    use_fingerprints = (skip_unchanged or store is not None) and not tags
+    fingerprints, new_fingerprints = {}, {}
+    if use_fingerprints:
+        fingerprints = dict(SuperTagContentFingerprint.objects.filter(
+            content_type=ctype, object_id=obj.pk).values_list(
+                'field', 'fingerprint'))
     
+    # Gather the text of each field
+    field_texts = []
     for item in params['fields']:
+        field = item.get('name')
         try:
             d = item.copy()
             
@@ -152,37 +252,122 @@ def process(obj, tags=[]):
             else:
                 data = '\n'.join([force_unicode(getattr(obj, item, '')) for item in comb_fields])
             
-            # Analyze the text (data)
-            result = c.analyze(data)
+            field_texts.append((field, proc_type, data, 
+                _get_fingerprint(c, data, proc_type)))
+        except Exception, e:
+            if settings.ST_DEBUG: raise Exception(e)
+            keep_fields.append(field)
+    
+    # The fields sent to Calais together. With 'single_request', all the 
+    # fields with the same process type are sent as one document.
+    if params.get('single_request'):
+        groups, by_type = [], {}
+        for f in field_texts:
+            if f[1] not in by_type:
+                by_type[f[1]] = []
+                groups.append(by_type[f[1]])
+            by_type[f[1]].append(f)
+    else:
+        groups = [[f] for f in field_texts]
+    
+    # Skip the groups whose text has not changed, and use the stored 
+    # response when the text was analyzed before.
+    analyzed, results, texts = [], {}, {}
+    for group in groups:
+        key = tuple([f[0] for f in group])
+        try:
+            if skip_unchanged and not force and not [f for f in group 
+                if fingerprints.get(f[0]) != f[3]]:
+                keep_fields.extend(key)
+                continue
+            
+            proc_type = group[0][1]
+            if len(group) == 1:
+                data, fingerprint = group[0][2], group[0][3]
+            else:
+                data = FIELD_SEPARATOR.join([f[2] for f in group])
+                fingerprint = _get_fingerprint(c, data, proc_type)
+            
+            raw = store and _get_stored_response(store, fingerprint)
+            if raw:
+                results[key] = CalaisResponse(raw)
+            elif offline and data.strip():
+                keep_fields.extend(key)
+                continue
+            else:
+                texts[key] = (data, proc_type)
+            analyzed.append((key, group, fingerprint))
+        except Exception, e:
+            if settings.ST_DEBUG: raise Exception(e)
+            keep_fields.extend(key)
+    
+    # Analyze the remaining groups at the same time
+    if texts:
+        results.update(c.analyze_many(texts, 
+            max_workers=settings.OPEN_CALAIS['MAX_WORKERS'],
+            max_size=settings.OPEN_CALAIS['MAX_DOCUMENT_SIZE'],
+            rate_limiter=get_rate_limiter(requests_per_second or 
+                settings.OPEN_CALAIS['REQUESTS_PER_SECOND'],
+                settings.OPEN_CALAIS['DAILY_QUOTA'], _count_calais_request)))
+        # Let the caller know to stop sending objects for now
+        for result in results.values():
+            if isinstance(result, (CalaisQuotaExceeded, CircuitOpen)):
+                raise result
+    
+    fields = []
+    for key, group, fingerprint in analyzed:
+        result = results[key]
+        field_results = dict([(f[0], result) for f in group])
+        if not isinstance(result, Exception) and result is not None:
+            if store and key in texts:
+                _store_response(store, fingerprint, result.raw_result)
+            if len(group) > 1:
+                field_results = _split_result(result, 
+                    [(f[0], len(f[2])) for f in group])
+        for field, proc_type, data, field_fingerprint in group:
+            fields.append((field, proc_type, field_fingerprint, 
+                field_results[field]))
+    
+    for field, proc_type, fingerprint, result in fields:
+        try:
+            if isinstance(result, Exception):
+                raise result
             
             entities, relations, topics, socialtags = [], [], [], []
+            # The fingerprint is only kept if nothing failed, so the field 
+            # is processed again next time
+            complete = True
             # Process entities, relations and topics
             if hasattr(result, 'entities'):
                 try:
                     entities = _processEntities(field, result.entities, 
-                        obj, ctype, proc_type, tags, date)
+                        obj, ctype, proc_type, tags, date, tagged_items)
                 except Exception, e:
+                    complete = False
                     if settings.ST_DEBUG: raise Exception("Failed to process Entities: %s" % e)
                     
             if hasattr(result, 'relations') and settings.PROCESS_RELATIONS:
                 try:
                     relations = _processRelations(field, result.relations, obj, 
-                        ctype, proc_type, tags, date)
+                        ctype, proc_type, tags, date, relation_items)
                 except Exception, e:
+                    complete = False
                     if settings.ST_DEBUG: raise Exception("Failed to process Relations: %s" % e)    
 
             if hasattr(result, 'topics') and settings.PROCESS_TOPICS:
                 try:
                     topics =  _processTopics(field, result.topics, obj, 
-                        ctype, tags, date)
+                        ctype, tags, date, tagged_items)
                 except Exception, e:
+                    complete = False
                     if settings.ST_DEBUG: raise Exception("Failed to process Topics: %s" % e)
             
             if hasattr(result, 'socialTag') and settings.PROCESS_SOCIALTAGS:
                 try:
                     socialtags = _processSocialTags(field, result.socialTag, obj, 
-                        ctype, tags, date)
+                        ctype, tags, date, tagged_items)
                 except Exception, e:
+                    complete = False
                     if settings.ST_DEBUG: raise Exception("Failed to process SocialTags: %s" % e)
             
             processed_tags.extend(entities)
@@ -191,11 +376,24 @@ def process(obj, tags=[]):
             
             if settings.MARKUP:
                 invalidate_markup_cache(obj, field)
+            
+            new_fingerprints[field] = complete and fingerprint or None
                 
         except Exception, e:
             if settings.ST_DEBUG: raise Exception(e)
+            keep_fields.append(field)
             continue
-
+    
+    if len(keep_fields) == len(params['fields']):
+        # Nothing was analyzed, so nothing can have changed.
+        return processed_tags
+    
+    _sync_tagged_items(ctype, obj, tagged_items, keep_fields)
+    if settings.PROCESS_RELATIONS:
+        _sync_relation_items(ctype, obj, relation_items, keep_fields)
+    if use_fingerprints:
+        _save_fingerprints(ctype, obj, fingerprints, new_fingerprints, 
+            [f['name'] for f in params['fields']])
     return processed_tags
 
 def clean_up(obj):
@@ -205,18 +403,23 @@ def clean_up(obj):
     """
     try:
         cont_type = ContentType.objects.get_for_model(obj)
-        SuperTaggedItem.objects.filter(content_type=cont_type, 
-            object_id=obj.pk).delete()
+        items = SuperTaggedItem.objects.filter(content_type=cont_type, 
+            object_id=obj.pk)
+        SuperTagUsage.objects.record(removed=items.filter(ignore=False).only(
+            'tag', 'content_type', 'ignore'))
+        items.delete()
         SuperTaggedRelationItem.objects.filter(content_type=cont_type, 
             object_id=obj.pk).delete()
+        SuperTagContentFingerprint.objects.filter(content_type=cont_type, 
+            object_id=obj.pk).delete()
     except Exception, e:
         if settings.ST_DEBUG: raise Exception(e)
     # TODO, clean up tags that have no related items?
     # Same for relations?
 
-def _processEntities(field, data, obj, ctype, process_type, tags, date):
+def _processEntities(field, data, obj, ctype, process_type, tags, date, items):
     """
-    Process Entities.
+    Process Entities, adding the tagged items to ``items``.
     """
     processed_tags = []
     for e in data:
@@ -247,65 +450,29 @@ def _processEntities(field, data, obj, ctype, process_type, tags, date):
             continue
         
         display_name = entity.pop('name', '')
-        name = display_name.lower()
+        name = normalize_tag_name(display_name)
         if tags and name not in tags:
             continue
         
-        slug = slugify(name)
-        tag = None
-        try:
-            tag = SuperTag.objects.get_by_name(name__iexact=name, stype=stype)
-        except SuperTag.DoesNotExist:
-            try:
-                tag = SuperTag.objects.get(calais_id=calais_id)
-            except SuperTag.DoesNotExist:
-                kwargs = {
-                    'calais_id': calais_id,
-                    'slug': slug,
-                    'stype': stype,
-                    'name': name,
-                }
-                if settings.INCLUDE_DISPLAY_FIELDS:
-                    kwargs['display_name'] = display_name
-                tag = SuperTag.objects.create_alternate(**kwargs)
-        except SuperTag.MultipleObjectsReturned:
-            tag = SuperTag.objects.filter(name__iexact=name)[0]
-            
-        tag = tag.substitute or tag
+        tag = _get_tag(calais_id, name, display_name, stype)
         
         # If this tag was added to exlcude list, move onto the next item.
         if not tag.enabled:
             continue
             
-        tag.properties = entity
-        tag.save()
-            
-        # Check to make sure that the entity is not already attached
-        # to the content object, if it is, just append the instances. This
-        # should elimiate entities returned with different names such as
-        # 'Washington' and 'Washington DC' but same id
-        try:
-            it = SuperTaggedItem.objects.get(tag=tag, content_type=ctype, 
-                object_id=obj.pk, field=field)
-            it.instances.append(inst)
-            it.item_date = date
-            # Take the higher relevance
-            if rel > it.relevance:
-                it.relevance = rel
-            it.save()
-        except SuperTaggedItem.DoesNotExist:
-            # Create the record that will associate content to tags
-            it = SuperTaggedItem.objects.create(tag=tag, 
-                content_type=ctype, object_id=obj.pk, field=field, 
-                process_type=process_type, relevance=rel, instances=inst, 
-                item_date=date)
+        _update_tag_properties(tag, entity)
+        
+        # Entities returned with different names but the same id, such as
+        # 'Washington' and 'Washington DC', are merged into one item.
+        _add_tagged_item(items, tag, ctype, obj, field, process_type, rel, 
+            inst, date)
 
         processed_tags.append(tag)
     return processed_tags
 
-def _processRelations(field, data, obj, ctype, process_type, tags, date):
+def _processRelations(field, data, obj, ctype, process_type, tags, date, items):
     """
-    Process Relations
+    Process Relations, adding the relation items to ``items``.
     """
     for d in data:
         di = d.copy()
@@ -349,10 +516,8 @@ def _processRelations(field, data, obj, ctype, process_type, tags, date):
             if tags and entity_value not in tags:
                 continue
             
-            try:
-                entity = SuperTag.objects.get(calais_id=entity_value)
-                entity = entity.substitute or entity
-            except SuperTag.DoesNotExist:
+            entity = _get_tag_by_calais_id(entity_value)
+            if entity is None:
                 continue
                 
             if not entity.enabled:
@@ -361,11 +526,15 @@ def _processRelations(field, data, obj, ctype, process_type, tags, date):
             rel_item, rel_created = SuperTagRelation.objects.get_or_create(
                 tag=entity, name=entity_key, stype=rel_type, properties=_vals)
 
-            SuperTaggedRelationItem.objects.create(relation=rel_item, 
-                content_type=ctype, object_id=obj.pk, field=field, 
-                process_type=process_type, instances=inst, item_date=date)
+            key = (rel_item.pk, field)
+            if key in items:
+                items[key].instances = (items[key].instances or []) + list(inst)
+            else:
+                items[key] = SuperTaggedRelationItem(relation=rel_item, 
+                    content_type=ctype, object_id=obj.pk, field=field, 
+                    process_type=process_type, instances=inst, item_date=date)
 
-def _processTopics(field, data, obj, ctype, tags, date):
+def _processTopics(field, data, obj, ctype, tags, date, items):
     """
     Process Topics, this opertaion is similar to _processEntities, the only
     difference is that there are no instances
@@ -377,47 +546,26 @@ def _processTopics(field, data, obj, ctype, tags, date):
         calais_id = re.match(REF_REGEX, str(di.pop('category'))).group('key')
         stype = 'Topic'
         display_name = di.pop('categoryName', '')
-        name = display_name.lower()
+        name = normalize_tag_name(display_name)
         
         if tags and name not in tags:
             continue
         rel = int(float(str(di.pop('score', '0'))) * 1000)
         
-        slug = slugify(name)
-        tag = None
-        try:
-            tag = SuperTag.objects.get_by_name(name__iexact=name)
-        except SuperTag.DoesNotExist:
-            try:
-                tag = SuperTag.objects.get(calais_id=calais_id)
-            except SuperTag.DoesNotExist:
-                kwargs = {
-                    'calais_id': calais_id,
-                    'slug': slug,
-                    'stype': stype,
-                    'name': name,
-                }
-                if settings.INCLUDE_DISPLAY_FIELDS:
-                    kwargs['display_name'] = display_name
-                tag = SuperTag.objects.create_alternate(**kwargs)
-        except SuperTag.MultipleObjectsReturned:
-            tag = SuperTag.objects.filter(name__iexact=name)[0]
-            
-        tag = tag.substitute or tag
+        tag = _get_tag(calais_id, name, display_name, stype, 
+            match_stype=False)
         
         if not tag.enabled:
             continue
 
-        tag.properties = di
-        tag.save()
-
-        SuperTaggedItem.objects.create(tag=tag, content_type=ctype, 
-            object_id=obj.pk, field=field, relevance=rel, item_date=date)
+        _update_tag_properties(tag, di)
+        
+        _add_tagged_item(items, tag, ctype, obj, field, None, rel, None, date)
 
         processed_tags.append(tag)
     return processed_tags
 
-def _processSocialTags(field, data, obj, ctype, tags, date):
+def _processSocialTags(field, data, obj, ctype, tags, date, items):
     """
     Process Topics, this opertaion is similar to _processEntities, the only
     difference is that there are no instances
@@ -430,44 +578,337 @@ def _processSocialTags(field, data, obj, ctype, tags, date):
         calais_id = re.match(REF_REGEX, str(di.pop('socialTag'))).group('key')
         stype = 'Social Tag'
         display_name = di.pop('name', '')
-        name = display_name.lower()
+        name = normalize_tag_name(display_name)
         if tags and name not in tags:
             continue
         rel = rel_map.get(di.get('importance', '3'), 500)
-        slug = slugify(name)
-        tag = None
-        try:
-            tag = SuperTag.objects.get_by_name(name__iexact=name)
-        except SuperTag.DoesNotExist:
-            try:
-                tag = SuperTag.objects.get(calais_id=calais_id)
-            except SuperTag.DoesNotExist:
-                kwargs = {
-                    'calais_id': calais_id,
-                    'slug': slug,
-                    'stype': stype,
-                    'name': name,
-                }
-                if settings.INCLUDE_DISPLAY_FIELDS:
-                    kwargs['display_name'] = display_name
-                tag = SuperTag.objects.create_alternate(**kwargs)
-        except SuperTag.MultipleObjectsReturned:
-            tag = SuperTag.objects.filter(name__iexact=name)[0]
-            
-        tag = tag.substitute or tag
+        tag = _get_tag(calais_id, name, display_name, stype, 
+            match_stype=False)
         
         if not tag.enabled:
             continue
 
-        tag.properties = di
-        tag.save()
-
-        SuperTaggedItem.objects.create(tag=tag, content_type=ctype, 
-            object_id=obj.pk, field=field, relevance=rel, item_date=date)
+        _update_tag_properties(tag, di)
+        
+        _add_tagged_item(items, tag, ctype, obj, field, None, rel, None, date)
 
         processed_tags.append(tag)
     return processed_tags
 
+def _update_tag_properties(tag, properties):
+    """
+    Save the properties Calais returned for ``tag``, skipping the write
+    when they have not changed. Only the properties are written, so a 
+    cached ``tag`` doesn't undo changes made to the tag since it was read. 
+    Cached tags are shared between threads and are never changed; the 
+    properties written are remembered in ``_tag_properties`` instead.
+    """
+    if _tag_properties.get(tag.pk, tag.properties) != properties:
+        SuperTag.objects.filter(pk=tag.pk).update(properties=properties)
+        on_commit(lambda: _tag_properties.set(tag.pk, properties))
+
+def _add_tagged_item(items, tag, ctype, obj, field, process_type, rel, inst, date):
+    """
+    Add an unsaved ``SuperTaggedItem`` to ``items``. If the tag is already 
+    attached to the field, the instances are concatenated and the higher 
+    relevance is kept.
+    """
+    key = (tag.pk, field)
+    if key in items:
+        it = items[key]
+        if inst:
+            it.instances = (it.instances or []) + list(inst)
+        # Take the higher relevance
+        if rel > it.relevance:
+            it.relevance = rel
+    else:
+        items[key] = SuperTaggedItem(tag=tag, content_type=ctype, 
+            object_id=obj.pk, field=field, process_type=process_type, 
+            relevance=rel, instances=inst, item_date=date)
+
+CIRCUIT_CACHE_KEY = 'supertagging_calais_circuit'
+
+def _record_circuit_state(state, failures, opened_at):
+    """
+    Keep the state of the circuit breaker in the cache for monitoring.
+    """
+    cache.set(CIRCUIT_CACHE_KEY, {'state': state, 'failures': failures, 
+        'opened_at': opened_at, 'pid': os.getpid()}, 60 * 60 * 24)
+
+def get_calais_status():
+    """
+    The last state change of the circuit breaker around Calais calls, in 
+    any process sharing the cache: a dict with the ``state`` (``closed``, 
+    ``open`` or ``half-open``), the number of consecutive ``failures``, 
+    the time it ``opened_at`` and the ``pid`` of the process.
+    """
+    return cache.get(CIRCUIT_CACHE_KEY) or {'state': 'closed', 
+        'failures': 0, 'opened_at': None, 'pid': None}
+
+def _count_calais_request(day):
+    """
+    Count a Calais request in the cache, so every process using the same 
+    cache shares the DAILY_QUOTA. Returns the number of requests that day.
+    """
+    key = 'supertagging_calais_requests_%s' % day.isoformat()
+    cache.add(key, 0, 60 * 60 * 25)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # The key was evicted, start counting again
+        cache.set(key, 1, 60 * 60 * 25)
+        return 1
+
+# Put between fields sent to Calais as one document
+FIELD_SEPARATOR = u'\n\n'
+
+class FieldResult(object):
+    """
+    The part of a Calais response about one field of a document made of 
+    several fields.
+    """
+    pass
+
+def _split_result(result, fields):
+    """
+    Split the response to several fields sent as one document into a 
+    result per field. ``fields`` is a list of (field, text length), in the 
+    order they were joined with FIELD_SEPARATOR.
+    
+    Each instance of an entity or relation is moved to the field it was 
+    found in, with its offset relative to that field. Topics, social tags 
+    and items without instances are about the whole document and go to 
+    the first field.
+    """
+    bounds, start = [], 0
+    for field, length in fields:
+        bounds.append((field, start, start + length))
+        start += length + len(FIELD_SEPARATOR)
+    first = fields[0][0]
+    parts = dict([(f, FieldResult()) for f, l in fields])
+    
+    for attr in ('entities', 'relations'):
+        if not hasattr(result, attr):
+            continue
+        for part in parts.values():
+            setattr(part, attr, [])
+        for item in getattr(result, attr):
+            instances = item.get('instances')
+            if not instances:
+                getattr(parts[first], attr).append(item)
+                continue
+            by_field = {}
+            for inst in instances:
+                offset = inst.get('offset', 0)
+                for field, begin, end in bounds:
+                    if begin <= offset < end:
+                        inst = dict(inst, offset=offset - begin)
+                        by_field.setdefault(field, []).append(inst)
+                        break
+            for field, field_instances in by_field.items():
+                getattr(parts[field], attr).append(
+                    dict(item, instances=field_instances))
+    
+    for attr in ('topics', 'socialTag'):
+        if hasattr(result, attr):
+            setattr(parts[first], attr, getattr(result, attr))
+    return parts
+
+def _get_stored_response(store, fingerprint):
+    """
+    The stored response for ``fingerprint``, or None if there is none or 
+    the store failed.
+    """
+    try:
+        return store.get(fingerprint)
+    except Exception, e:
+        if settings.ST_DEBUG: print "Error reading a stored response: %s" % e
+        return None
+
+def _store_response(store, fingerprint, raw_response):
+    """
+    Store a response. The tags are saved even if the store failed.
+    """
+    sid = transaction.savepoint()
+    try:
+        store.set(fingerprint, raw_response)
+        transaction.savepoint_commit(sid)
+    except Exception, e:
+        transaction.savepoint_rollback(sid)
+        if settings.ST_DEBUG: print "Error storing a response: %s" % e
+
+def _get_fingerprint(calais, data, process_type):
+    """
+    A hash of the text sent to Calais and how it was sent.
+    """
+    return calais.get_content_id(u'%s\n%s' % (process_type, data))
+
+def _save_fingerprints(ctype, obj, old, new, fields):
+    """
+    Record the ``new`` fingerprints of the analyzed fields and drop the 
+    fingerprints of fields that are no longer watched, or whose fingerprint 
+    is None because they were not completely processed.
+    """
+    stale = [f for f in old if f not in fields or (f in new and not new[f])]
+    for field, fingerprint in new.items():
+        if not fingerprint:
+            continue
+        rows = SuperTagContentFingerprint.objects.filter(content_type=ctype, 
+            object_id=obj.pk, field=field)
+        if field in old and rows.update(fingerprint=fingerprint, 
+            date_processed=datetime.datetime.now()):
+            continue
+        sid = transaction.savepoint()
+        try:
+            SuperTagContentFingerprint.objects.create(content_type=ctype, 
+                object_id=obj.pk, field=field, fingerprint=fingerprint)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Another worker processed the object in the meantime
+            transaction.savepoint_rollback(sid)
+            rows.update(fingerprint=fingerprint, 
+                date_processed=datetime.datetime.now())
+    if stale:
+        SuperTagContentFingerprint.objects.filter(content_type=ctype, 
+            object_id=obj.pk, field__in=stale).delete()
+
+def _bulk_create(model, items):
+    """
+    Write new items, in one query where the database API allows it.
+    """
+    if not items:
+        return
+    if hasattr(model.objects, 'bulk_create'):
+        # Django 1.4 and up
+        model.objects.bulk_create(items)
+    else:
+        for it in items:
+            it.save()
+
+def _sync_items(existing, items, key_func, fields):
+    """
+    Compare the ``existing`` items with the new ``items`` (keyed by 
+    ``key_func``) and only write the differences: new keys are inserted, 
+    keys with different values for ``fields`` are updated and keys that 
+    are gone are deleted. Returns the created and deleted items.
+    """
+    to_delete = []
+    for it in existing:
+        key = key_func(it)
+        new = items.pop(key, None)
+        if new is None:
+            # Gone, or a duplicate of an item already compared
+            to_delete.append(it)
+            continue
+        changed = False
+        for f in fields:
+            if getattr(it, f) != getattr(new, f):
+                setattr(it, f, getattr(new, f))
+                changed = True
+        if changed:
+            it.save()
+    
+    to_create = items.values()
+    if to_delete:
+        existing.model.objects.filter(
+            pk__in=[it.pk for it in to_delete]).delete()
+    _bulk_create(existing.model, to_create)
+    return to_create, to_delete
+
+def _sync_tagged_items(ctype, obj, items, keep_fields):
+    """
+    Bring the tagged items of ``obj`` in line with ``items``. Items of 
+    ``keep_fields`` are left as they are, and so are tags an editor has 
+    marked as ignored. The usage counts are updated with the difference.
+    """
+    existing = SuperTaggedItem.objects.filter(content_type=ctype, 
+        object_id=obj.pk).exclude(field__in=keep_fields)
+    for tag_id, field in existing.filter(ignore=True).values_list('tag', 'field'):
+        items.pop((tag_id, field), None)
+    
+    created, deleted = _sync_items(existing.filter(ignore=False), items, 
+        lambda it: (it.tag_id, it.field), 
+        ('relevance', 'instances', 'item_date', 'process_type'))
+    SuperTagUsage.objects.record(added=created, removed=deleted)
+    return created, deleted
+
+def _sync_relation_items(ctype, obj, items, keep_fields):
+    """
+    Bring the tagged relation items of ``obj`` in line with ``items``.
+    """
+    existing = SuperTaggedRelationItem.objects.filter(content_type=ctype, 
+        object_id=obj.pk).exclude(field__in=keep_fields)
+    return _sync_items(existing, items, 
+        lambda it: (it.relation_id, it.field), 
+        ('instances', 'item_date', 'process_type'))
+
+def _get_tag(calais_id, name, display_name, stype, match_stype=True):
+    """
+    Find the tag to use for a Calais entity, looking it up by name (and 
+    type, if ``match_stype``), then by Calais ID, and creating it if 
+    neither exists. Resolutions are kept in ``tag_cache`` so hot entities 
+    cost a dictionary lookup instead of two or three queries.
+    """
+    normalized_name = normalize_tag_name(name)
+    name_key = ('name', normalized_name, stype)
+    calais_key = ('calais', calais_id)
+    tag = tag_cache.get(name_key)
+    if tag is not None:
+        return tag
+    
+    lookup = {'normalized_name': normalized_name}
+    if match_stype:
+        lookup['stype'] = stype
+    try:
+        tag = SuperTag.objects.get_by_name(**lookup)
+    except SuperTag.DoesNotExist:
+        # The Calais ID is only used when no tag has the name
+        tag = tag_cache.get(calais_key)
+        if tag is not None:
+            cache_tag([name_key], tag)
+            return tag
+        try:
+            tag = SuperTag.objects.get(calais_id=calais_id)
+        except SuperTag.DoesNotExist:
+            kwargs = {
+                'calais_id': calais_id,
+                'slug': slugify(name),
+                'stype': stype,
+                'name': name,
+            }
+            if settings.INCLUDE_DISPLAY_FIELDS:
+                kwargs['display_name'] = display_name
+            sid = transaction.savepoint()
+            try:
+                tag = SuperTag.objects.create_alternate(**kwargs)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Another worker created the tag in the meantime
+                transaction.savepoint_rollback(sid)
+                tag = SuperTag.objects.get(calais_id=calais_id)
+    except SuperTag.MultipleObjectsReturned:
+        tag = SuperTag.objects.filter(**lookup)[0]
+    
+    tag = tag.substitute or tag
+    cache_tag([name_key, calais_key], tag)
+    return tag
+
+def _get_tag_by_calais_id(calais_id):
+    """
+    Return the tag to use for ``calais_id``, or ``None`` if there is no
+    such tag.
+    """
+    calais_key = ('calais', calais_id)
+    tag = tag_cache.get(calais_key)
+    if tag is None:
+        try:
+            tag = SuperTag.objects.get(calais_id=calais_id)
+        except SuperTag.DoesNotExist:
+            return None
+        tag = tag.substitute or tag
+        cache_tag([calais_key], tag)
+    return tag
+
 def _getEntityText(key):
     """
     Try to resolve the entity given the key
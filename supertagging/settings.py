@@ -23,6 +23,16 @@ DEFAULT_CALAIS_SETTINGS = {
     'PROCESS_TOPICS': False,
     'PROCESS_SOCIALTAGS': False,
     'DEFAULT_PROCESS_TYPE': 'TEXT/RAW', 
+    'POOL_SIZE': 4, # Number of idle keep-alive connections to keep open
+    'TIMEOUT': 30, # Seconds to wait on the OpenCalais API before giving up
+    'MAX_WORKERS': 8, # Number of requests sent to OpenCalais at once
+    'REQUESTS_PER_SECOND': 4, # Most requests sent to OpenCalais per second
+    'DAILY_QUOTA': None, # Most requests sent to OpenCalais per day
+    'FAILURE_THRESHOLD': 5, # Failed requests in a row before OpenCalais
+                            # is no longer called for a while, None: never
+    'FAILURE_COOLDOWN': 60, # Seconds before OpenCalais is tried again
+    'MAX_DOCUMENT_SIZE': 100000, # Characters sent in one request, longer
+                                 # texts are split, None: never split
 }
 DEFAULT_EXCLUSIONS = {
     'TAG_TYPE_EXCLUSIONS': [], # exclude tags of certian types from saving
@@ -49,6 +59,12 @@ DEFAULT_MARKUP_SETTINGS = {
     'MIN_RELEVANCE': 0, # Minimum relevance of a tag to include it in 
                            # automatic markup of the content (0-1000)
 }
+DEFAULT_RESPONSE_STORE_SETTINGS = {
+    'BACKEND': None, # Where to keep the raw responses from Calais, eg:
+                     # 'supertagging.stores.FileSystemResponseStore' or
+                     # 'supertagging.stores.DatabaseResponseStore'
+    'LOCATION': '', # The directory used by the file system store
+}
 DEFAULT_SETTINGS = {
     'ENABLED': False, # Enable supertagging. This will allow starting and 
                       # stopping tag processing while preserving AUTO_PROCESS
@@ -76,6 +92,22 @@ DEFAULT_SETTINGS = {
     'FILE_STORAGE': settings.DEFAULT_FILE_STORAGE, # For the tag icon
     'USE_QUEUE': False, # True: add objects to a queue for later processing 
                         # False: process the item on save.
+    'QUEUE_LEASE_TIMEOUT': 3600, # Seconds before a queue item claimed by a
+                                 # worker that died is claimed again.
+    'QUEUE_MAX_ATTEMPTS': 5, # Times a queue item is tried before it is
+                             # marked as failed.
+    'BACKGROUND_WORKERS': 0, # When not using the queue, process saved
+                             # objects in this many background threads
+                             # instead of during the save. 0: don't.
+    'BACKGROUND_BACKLOG': 100, # Objects waiting for a background thread
+                               # before more are added to the queue.
+    'SKIP_UNCHANGED_CONTENT': True, # True: don't send a field to Calais again
+                                    # if its text hasn't changed since it was
+                                    # last processed.
+    'TAG_CACHE_SIZE': 10000, # Number of resolved tags kept in memory while
+                             # processing, 0 disables the cache.
+    'USAGE_CACHE_TIMEOUT': 0, # Seconds the tags_for_model and tag cloud
+                              # template tags cache their tags, 0: don't.
     'CONTENTTYPE_NAME_MAPPING': {}, # Names used enstead of integers when displaying the content. 
                                     # EX: {'stories': 322, 'photos': 129, 'entries': 102, 'polls': 754}
                                     # Where the value is the actual content type id and the key is the name
@@ -86,6 +118,7 @@ DEFAULT_SETTINGS = {
     # 'EXCLUSIONS': DEFAULT_EXCLUSIONS,
     # 'MARKUP': DEFAULT_MARKUP_SETTINGS,
     # 'FREEBASE': DEFAULT_FREEBASE_SETTINGS,
+    # 'RESPONSE_STORE': DEFAULT_RESPONSE_STORE_SETTINGS,
 }
 
 USER_SETTINGS = dict(DEFAULT_SETTINGS.items() + getattr(settings, 'SUPERTAGGING_SETTINGS', {}).items())
@@ -95,6 +128,7 @@ USER_SETTINGS['OPEN_CALAIS']['PROCESSING_DIRECTIVES'] = dict(DEFAULT_PROCESSING_
 USER_SETTINGS['EXCLUSIONS'] = dict(DEFAULT_EXCLUSIONS.items() + USER_SETTINGS.get('EXCLUSIONS', {}).items())
 USER_SETTINGS['MARKUP'] = dict(DEFAULT_MARKUP_SETTINGS.items() + USER_SETTINGS.get('MARKUP', {}).items())
 USER_SETTINGS['FREEBASE'] = dict(DEFAULT_FREEBASE_SETTINGS.items() + USER_SETTINGS.get('FREEBASE', {}).items())
+USER_SETTINGS['RESPONSE_STORE'] = dict(DEFAULT_RESPONSE_STORE_SETTINGS.items() + USER_SETTINGS.get('RESPONSE_STORE', {}).items())
 
 
 ERR_MSG = "Setting %s is deprecated; use SUPERTAGGING_SETTINGS['%s'] instead."
@@ -0,0 +1,124 @@
+"""
+Stores for the raw responses returned by Calais, so tags can be rebuilt 
+from them without calling Calais again. Responses are compressed and kept 
+by the fingerprint of the text that was analyzed.
+"""
+import os, gzip, zlib, base64, tempfile
+from django.utils.importlib import import_module
+from django.db import transaction, IntegrityError
+
+from supertagging import settings
+
+def _to_bytes(raw_response):
+    if isinstance(raw_response, unicode):
+        return raw_response.encode('utf8')
+    return raw_response
+
+class BaseResponseStore(object):
+    """
+    Interface for response stores.
+    """
+    def get(self, fingerprint):
+        """
+        Return the raw response stored for ``fingerprint``, or ``None``.
+        """
+        raise NotImplementedError
+        
+    def set(self, fingerprint, raw_response):
+        """
+        Store the raw response for ``fingerprint``.
+        """
+        raise NotImplementedError
+
+
+class FileSystemResponseStore(BaseResponseStore):
+    """
+    Keeps each response as a gzipped file in ``location``, spread over 
+    sub directories named after the first two characters of the 
+    fingerprint.
+    """
+    def __init__(self, location=None):
+        self.location = location or settings.RESPONSE_STORE['LOCATION']
+        if not self.location:
+            raise ValueError("RESPONSE_STORE['LOCATION'] is required by "
+                "the file system store.")
+    
+    def _path(self, fingerprint):
+        return os.path.join(self.location, fingerprint[:2], 
+            '%s.json.gz' % fingerprint)
+    
+    def get(self, fingerprint):
+        try:
+            f = gzip.open(self._path(fingerprint), 'rb')
+        except IOError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+    
+    def set(self, fingerprint, raw_response):
+        path = self._path(fingerprint)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process in the meantime
+                pass
+        # Write to a temporary file first so readers never see half a file
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        tmp_file = os.fdopen(fd, 'wb')
+        try:
+            f = gzip.GzipFile(fileobj=tmp_file, mode='wb')
+            f.write(_to_bytes(raw_response))
+            f.close()
+        finally:
+            tmp_file.close()
+        os.rename(tmp_path, path)
+
+
+class DatabaseResponseStore(BaseResponseStore):
+    """
+    Keeps each response zlib compressed in the ``SuperTagCalaisResponse`` 
+    table.
+    """
+    def get(self, fingerprint):
+        from supertagging.models import SuperTagCalaisResponse
+        try:
+            data = SuperTagCalaisResponse.objects.filter(
+                fingerprint=fingerprint).values_list('data', flat=True)[0]
+        except IndexError:
+            return None
+        return zlib.decompress(base64.b64decode(data))
+    
+    def set(self, fingerprint, raw_response):
+        from supertagging.models import SuperTagCalaisResponse
+        data = base64.b64encode(zlib.compress(_to_bytes(raw_response)))
+        if SuperTagCalaisResponse.objects.filter(
+            fingerprint=fingerprint).update(data=data):
+            return
+        sid = transaction.savepoint()
+        try:
+            SuperTagCalaisResponse.objects.create(fingerprint=fingerprint, 
+                data=data)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Another worker stored the same text in the meantime
+            transaction.savepoint_rollback(sid)
+
+
+_stores = {}
+
+def get_response_store():
+    """
+    Return the store set in RESPONSE_STORE['BACKEND'], or ``None`` if 
+    responses are not stored.
+    """
+    backend = settings.RESPONSE_STORE['BACKEND']
+    if not backend:
+        return None
+    if backend not in _stores:
+        module, attr = backend.rsplit('.', 1)
+        _stores[backend] = getattr(import_module(module), attr)()
+    return _stores[backend]
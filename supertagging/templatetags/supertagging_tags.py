@@ -1,6 +1,6 @@
 # Most template tags were borrowed from django-tagging.
 
-import django
+import django, hashlib
 from django.db.models import get_model
 from django.template import (Library, Node, TemplateSyntaxError, Variable, 
                             resolve_variable, VariableDoesNotExist)
@@ -18,13 +18,58 @@ from django.utils.safestring import mark_safe
 from django.utils.encoding import smart_unicode, force_unicode
 from django.utils.html import escape, conditional_escape
 from django.db import models
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
 
+from supertagging import settings as st_settings
 from supertagging.models import (SuperTag, SuperTaggedItem, SuperTagRelation, 
-                                 SuperTaggedRelationItem)
+                                 SuperTaggedRelationItem, get_usage_generation)
 from supertagging.utils import LINEAR, LOGARITHMIC
 
 register = Library()
 
+def _resolve_filters(filters, context):
+    """
+    The filters of a node with the values that are template variables 
+    resolved, leaving the node's own filters as they are.
+    """
+    resolved = {}
+    for k,v in (filters or {}).items():
+        try:
+            v = Variable(v).resolve(context)
+        except:
+            pass
+        resolved[k] = v
+    return resolved
+
+def _key_value(value):
+    """
+    A stable representation of a value in the key of cached usage.
+    """
+    if isinstance(value, dict):
+        return sorted([(k, _key_value(v)) for k, v in value.items()])
+    if isinstance(value, models.Model):
+        return (value._meta.app_label, value._meta.object_name, value.pk)
+    return value
+
+def get_cached_usage(func, model, **kwargs):
+    """
+    Return ``func(model, **kwargs)``, cached for USAGE_CACHE_TIMEOUT 
+    seconds. The key holds the usage generation of the model, so it 
+    changes as soon as the model's tagged items do.
+    """
+    if not st_settings.USAGE_CACHE_TIMEOUT:
+        return func(model, **kwargs)
+    ctype_id = ContentType.objects.get_for_model(model).pk
+    key = 'ST_USAGE.%s.%s.%s.%s' % (func.__name__, ctype_id, 
+        get_usage_generation(ctype_id), 
+        hashlib.md5(repr(_key_value(kwargs))).hexdigest())
+    result = cache.get(key)
+    if result is None:
+        result = list(func(model, **kwargs))
+        cache.set(key, result, st_settings.USAGE_CACHE_TIMEOUT)
+    return result
+
 class TagsForModelNode(Node):
     def __init__(self, model, context_var, counts, **kwargs):
         self.model = model
@@ -37,14 +82,10 @@ class TagsForModelNode(Node):
         if model is None:
             raise TemplateSyntaxError(_('supertags_for_model tag was given an invalid model: %s') % self.model)
         
-        if 'filters' in self.kwargs and isinstance(self.kwargs['filters'], dict):
-            for k,v in self.kwargs['filters'].items():
-                try:
-                    v = Variable(v).resolve(context)
-                    self.kwargs['filters'][k] = v
-                except:
-                    continue
-        context[self.context_var] = SuperTag.objects.usage_for_model(model, counts=self.counts)
+        filters = _resolve_filters(self.kwargs.get('filters'), context)
+        context[self.context_var] = get_cached_usage(
+            SuperTag.objects.usage_for_model, model, counts=self.counts, 
+            filters=filters or None)
         return ''
 
 class TagCloudForModelNode(Node):
@@ -58,15 +99,10 @@ class TagCloudForModelNode(Node):
         if model is None:
             raise TemplateSyntaxError(_('supertag_cloud_for_model tag was given an invalid model: %s') % self.model)
         
-        if 'filters' in self.kwargs and isinstance(self.kwargs['filters'], dict):
-            for k,v in self.kwargs['filters'].items():
-                try:
-                    v = Variable(v).resolve(context)
-                    self.kwargs['filters'][k] = v
-                except:
-                    continue
-        context[self.context_var] = \
-            SuperTag.objects.cloud_for_model(model, **self.kwargs)
+        kwargs = dict(self.kwargs)
+        kwargs['filters'] = _resolve_filters(self.kwargs.get('filters'), context)
+        context[self.context_var] = get_cached_usage(
+            SuperTag.objects.cloud_for_model, model, **kwargs)
         return ''
 
 class TagsForObjectNode(Node):
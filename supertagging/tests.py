@@ -38,4 +38,925 @@ class PickledObjectFieldTests(TestCase):
             model_test.save()
             self.assertEquals(value, TestingModel.objects.get(pickle_field__exact=value).pickle_field)
             model_test.delete()
-            
\ No newline at end of file
+            
+
+class LRUCacheTests(TestCase):
+    def testEviction(self):
+        """Tests that the least recently used key is evicted first."""
+        from supertagging.utils import LRUCache
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+    
+    def testTagInvalidation(self):
+        """Tests that only changes affecting resolution clear cached tags."""
+        from supertagging.models import SuperTag, tag_cache
+        tag = SuperTag.objects.create(calais_id='abc', name='barack obama',
+            slug='barack-obama', stype='Person')
+        tag_cache.set(('calais', 'abc'), tag)
+        tag.properties = {'nationality': 'American'}
+        tag.save()
+        self.assertEquals(tag_cache.get(('calais', 'abc')), tag)
+        tag.enabled = False
+        tag.save()
+        self.assertEquals(tag_cache.get(('calais', 'abc')), None)
+
+    def testTagChangedElsewhere(self):
+        """Tests that a tag changed in another process empties the cache."""
+        from supertagging import models
+        from supertagging.models import (tag_cache, check_tag_cache,
+            _bump_generation, TAG_GENERATION_KEY)
+        old_shared, models._cache_is_shared = models._cache_is_shared, lambda: True
+        try:
+            check_tag_cache()
+            tag_cache.set(('calais', 'abc'), 'tag')
+            check_tag_cache()
+            self.assertEquals(tag_cache.get(('calais', 'abc')), 'tag')
+            _bump_generation(TAG_GENERATION_KEY)
+            check_tag_cache()
+            self.assertEquals(tag_cache.get(('calais', 'abc')), None)
+        finally:
+            models._cache_is_shared = old_shared
+
+    def testTagCacheWithLocalCache(self):
+        """Tests that tags aren't kept between objects when changes made 
+        elsewhere can't be seen."""
+        from supertagging.models import tag_cache, check_tag_cache
+        check_tag_cache()
+        tag_cache.set(('calais', 'abc'), 'tag')
+        check_tag_cache()
+        self.assertEquals(tag_cache.get(('calais', 'abc')), None)
+
+    def testRolledBackTagIsNotCached(self):
+        """Tests that tags are only cached once their transaction commits."""
+        from supertagging.models import tag_cache
+        from supertagging.modules import _get_tag
+        from supertagging.utils import (start_commit_callbacks,
+            stop_commit_callbacks, run_commit_callbacks,
+            discard_commit_callbacks)
+        tag_cache.clear()
+        start_commit_callbacks()
+        try:
+            _get_tag('abc', 'barack obama', 'Barack Obama', 'Person')
+            discard_commit_callbacks()
+            run_commit_callbacks()
+            self.assertEquals(tag_cache.get(('calais', 'abc')), None)
+            tag = _get_tag('abc', 'barack obama', 'Barack Obama', 'Person')
+            run_commit_callbacks()
+            self.assertEquals(tag_cache.get(('calais', 'abc')), tag)
+        finally:
+            stop_commit_callbacks()
+
+    def testCachedTagResolution(self):
+        """Tests that a tag with the name wins over a cached Calais ID, and
+        that new properties don't undo changes made to a cached tag."""
+        from supertagging.models import SuperTag, tag_cache
+        from supertagging.modules import _get_tag, _update_tag_properties
+        tag = SuperTag.objects.create(calais_id='abc', name='barack obama',
+            slug='barack-obama', stype='Person')
+        other = SuperTag.objects.create(calais_id='xyz', name='obama',
+            slug='obama', stype='Person')
+        tag_cache.set(('calais', 'abc'), tag)
+        self.assertEquals(_get_tag('abc', 'obama', 'Obama', 'Person'), other)
+
+        edited = SuperTag.objects.get(pk=tag.pk)
+        edited.name = 'president obama'
+        edited.save()
+        _update_tag_properties(tag, {'nationality': 'American'})
+        tag = SuperTag.objects.get(pk=tag.pk)
+        self.assertEquals(tag.name, 'president obama')
+        self.assertEquals(tag.properties, {'nationality': 'American'})
+
+
+class ConnectionPoolTests(TestCase):
+    def testStaleConnectionIsReplaced(self):
+        """Tests that a reused connection closed by the server is retried."""
+        import httplib
+        from supertagging.calais import ConnectionPool
+        opened = []
+        class FakeResponse(object):
+            status = 200
+            will_close = False
+            def read(self):
+                return 'ok'
+        class FakeConnection(object):
+            def __init__(self, host, timeout=None):
+                self.stale = False
+                opened.append(self)
+            def request(self, *args):
+                if self.stale:
+                    raise httplib.BadStatusLine('')
+            def getresponse(self):
+                return FakeResponse()
+            def close(self):
+                pass
+        pool = ConnectionPool(size=1)
+        pool.connection_class = FakeConnection
+        self.assertEquals(pool.request('POST', '/'), (200, 'ok'))
+        self.assertEquals(pool.request('POST', '/'), (200, 'ok'))
+        self.assertEquals(len(opened), 1)
+        opened[0].stale = True
+        self.assertEquals(pool.request('POST', '/'), (200, 'ok'))
+        self.assertEquals(len(opened), 2)
+
+    def testOnlyUnsentRequestsAreRetried(self):
+        """Tests that a reset before sending is retried but a timeout is not."""
+        import errno, socket
+        from supertagging.calais import ConnectionPool
+        errors, sent = [], []
+        class FakeResponse(object):
+            status = 200
+            will_close = False
+            def read(self):
+                return 'ok'
+        class FakeConnection(object):
+            def __init__(self, host, timeout=None):
+                pass
+            def request(self, *args):
+                if errors and errors[0][0] == 'send':
+                    raise errors.pop(0)[1]
+                sent.append(args)
+            def getresponse(self):
+                if errors:
+                    raise errors.pop(0)[1]
+                return FakeResponse()
+            def close(self):
+                pass
+        pool = ConnectionPool(size=1)
+        pool.connection_class = FakeConnection
+        pool.request('POST', '/')
+        errors.append(('send', socket.error(errno.ECONNRESET, 'reset')))
+        self.assertEquals(pool.request('POST', '/'), (200, 'ok'))
+        self.assertEquals(len(sent), 2)
+        errors.append(('receive', socket.timeout('timed out')))
+        self.assertRaises(socket.timeout, pool.request, 'POST', '/')
+        self.assertEquals(len(sent), 3)
+
+
+class RateLimiterTests(TestCase):
+    def testDailyQuota(self):
+        """Tests that requests past the daily quota are refused."""
+        from supertagging.calais import RateLimiter, CalaisQuotaExceeded
+        limiter = RateLimiter(daily_quota=2)
+        limiter.wait()
+        limiter.wait()
+        self.assertRaises(CalaisQuotaExceeded, limiter.wait)
+    
+    def testThrottledRequestIsRetried(self):
+        """Tests that a 429 or 503 response is retried after backing off."""
+        from supertagging.calais import Calais, CalaisResponse, CalaisThrottled
+        c = Calais('test')
+        c.backoff = 0
+        calls = []
+        def rest_POST(content, content_type=None):
+            calls.append(content)
+            if len(calls) == 1:
+                raise CalaisThrottled(429)
+            return ENTITY_RESPONSE
+        c.rest_POST = rest_POST
+        results = dict(c.analyze_many(['Barack Obama']))
+        self.assertTrue(isinstance(results[0], CalaisResponse))
+        self.assertEquals(len(calls), 2)
+
+    
+    def testCircuitBreaker(self):
+        """Tests that requests fail fast after repeated failures."""
+        import time
+        from supertagging.calais import CircuitBreaker, CircuitOpen
+        states = []
+        breaker = CircuitBreaker(2, 0.05, lambda *args: states.append(args[0]))
+        breaker.before_call()
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertRaises(CircuitOpen, breaker.before_call)
+        time.sleep(0.06)
+        breaker.before_call()
+        self.assertRaises(CircuitOpen, breaker.before_call)
+        breaker.record_success()
+        breaker.before_call()
+        self.assertEquals(states, ['open', 'half-open', 'closed'])
+
+    def testThrottledDocumentCountsOnce(self):
+        """Tests that a document throttled on every retry is one failure."""
+        from supertagging.calais import Calais, CircuitBreaker, CalaisThrottled
+        class FakePool(object):
+            requests = 0
+            def request(self, *args):
+                self.requests += 1
+                return 503, ''
+        pool, breaker = FakePool(), CircuitBreaker(2, 60)
+        c = Calais('test', pool=pool, circuit_breaker=breaker)
+        c.backoff = 0
+        results = dict(c.analyze_many(['Barack Obama']))
+        self.assertTrue(isinstance(results[0], CalaisThrottled))
+        self.assertEquals(pool.requests, c.max_retries + 1)
+        self.assertEquals((breaker.state, breaker.failures), ('closed', 1))
+
+
+class ProcessQueueTests(TestCase):
+    def testClaimsDoNotOverlap(self):
+        """Tests that two workers never claim the same queue item."""
+        from django.contrib.contenttypes.models import ContentType
+        from supertagging.models import SuperTagProcessQueue
+        ctype = ContentType.objects.get_for_model(TestingModel)
+        for i in range(5):
+            SuperTagProcessQueue.objects.create(content_type=ctype, object_id=i)
+        first = SuperTagProcessQueue.objects.claim('first', 3)
+        second = SuperTagProcessQueue.objects.claim('second', 3)
+        self.assertEquals([q.object_id for q in first], [0, 1, 2])
+        self.assertEquals([q.object_id for q in second], [3, 4])
+        self.assertEquals(SuperTagProcessQueue.objects.claim('third', 3), [])
+
+    def testHeldItemsAreNotClaimedAgain(self):
+        """Tests that items a worker still holds aren't in its next batch."""
+        from django.contrib.contenttypes.models import ContentType
+        from supertagging.models import SuperTagProcessQueue
+        ctype = ContentType.objects.get_for_model(TestingModel)
+        for i in range(3):
+            SuperTagProcessQueue.objects.create(content_type=ctype, object_id=i)
+        # The first item failed and stays locked until the queue is drained
+        self.assertEquals([q.object_id for q in
+            SuperTagProcessQueue.objects.claim('worker', 1)], [0])
+        self.assertEquals([q.object_id for q in
+            SuperTagProcessQueue.objects.claim('worker', 2)], [1, 2])
+        self.assertEquals(SuperTagProcessQueue.objects.claim('worker', 2), [])
+
+    def testPriorityOrdering(self):
+        """Tests that higher priority, then older, items are claimed first."""
+        from supertagging import settings
+        from supertagging.models import SuperTagProcessQueue
+        from supertagging.modules import add_to_queue
+        old_modules = settings.MODULES
+        settings.MODULES = {'supertagging.testingmodel': {
+            'fields': [{'name': 'pickle_field'}], 'priority': 5}}
+        try:
+            objs = [TestingModel.objects.create(pickle_field=i) for i in range(4)]
+            add_to_queue(objs[0], priority=0)
+            add_to_queue(objs[1])
+            add_to_queue(objs[2], priority=0)
+            add_to_queue(objs[3], priority=10)
+            add_to_queue(objs[2], priority=5)
+        finally:
+            settings.MODULES = old_modules
+        items = SuperTagProcessQueue.objects.claim('worker', 10)
+        self.assertEquals([i.object_id for i in items], 
+            [objs[3].pk, objs[1].pk, objs[2].pk, objs[0].pk])
+    
+    def testAddManyToQueue(self):
+        """Tests that objects are queued in bulk, skipping queued ones."""
+        from supertagging import settings
+        from supertagging.models import SuperTagProcessQueue
+        from supertagging.modules import add_to_queue, add_many_to_queue
+        objs = [TestingModel.objects.create(pickle_field=i) for i in range(5)]
+        add_to_queue(objs[0])
+        old_modules = settings.MODULES
+        settings.MODULES = {'supertagging.testingmodel': {
+            'fields': [{'name': 'pickle_field'}], 
+            'match_kwargs': {'pk__lt': objs[4].pk}}}
+        try:
+            self.assertNumQueries(5, add_many_to_queue, 
+                TestingModel.objects.all(), priority=1)
+            self.assertEquals(add_many_to_queue(objs), 0)
+        finally:
+            settings.MODULES = old_modules
+        self.assertEquals(sorted(SuperTagProcessQueue.objects.values_list(
+            'object_id', 'priority')), [(o.pk, 1) for o in objs[:4]])
+    
+    def testFailedItemIsQueuedAgain(self):
+        """Tests that adding a dead-lettered object retries it."""
+        from supertagging.models import SuperTagProcessQueue
+        from supertagging.modules import add_to_queue
+        obj = TestingModel.objects.create(pickle_field='Barack Obama')
+        add_to_queue(obj)
+        SuperTagProcessQueue.objects.update(failed=True, attempts=3, 
+            last_error='Lease expired')
+        self.assertEquals(SuperTagProcessQueue.objects.claim('worker', 10), [])
+        add_to_queue(obj)
+        items = SuperTagProcessQueue.objects.claim('worker', 10)
+        self.assertEquals([i.object_id for i in items], [obj.pk])
+        self.assertEquals((items[0].attempts, items[0].last_error), (1, ''))
+    
+    def testUnchangedSaveIsNotQueued(self):
+        """Tests that saves which don't touch watched fields are skipped."""
+        from django.db.models.signals import post_save, post_init
+        from supertagging import handlers, settings
+        from supertagging.models import SuperTagProcessQueue
+        old_modules, old_queue = settings.MODULES, handlers.USE_QUEUE
+        settings.MODULES = {'supertagging.testingmodel': {
+            'fields': [{'name': 'pickle_field'}]}}
+        handlers.USE_QUEUE = True
+        handlers._watched_attnames.clear()
+        post_init.connect(handlers.init_handler, sender=TestingModel)
+        post_save.connect(handlers.save_handler, sender=TestingModel)
+        try:
+            obj = TestingModel.objects.create(pickle_field='Barack Obama')
+            self.assertEquals(SuperTagProcessQueue.objects.count(), 1)
+            SuperTagProcessQueue.objects.all().delete()
+            obj = TestingModel.objects.get(pk=obj.pk)
+            obj.save()
+            self.assertEquals(SuperTagProcessQueue.objects.count(), 0)
+            obj.pickle_field = 'Joe Biden'
+            obj.save()
+            self.assertEquals(SuperTagProcessQueue.objects.count(), 1)
+            SuperTagProcessQueue.objects.all().delete()
+            obj.save()
+            self.assertEquals(SuperTagProcessQueue.objects.count(), 0)
+        finally:
+            post_init.disconnect(handlers.init_handler, sender=TestingModel)
+            post_save.disconnect(handlers.save_handler, sender=TestingModel)
+            settings.MODULES, handlers.USE_QUEUE = old_modules, old_queue
+            handlers._watched_attnames.clear()
+    
+    def testContentObjectsFetchedInBulk(self):
+        """Tests that a batch fetches its objects with one query per type."""
+        from django.contrib.contenttypes.models import ContentType
+        from supertagging.models import SuperTagProcessQueue
+        from supertagging.management.commands.st_process_queue import Core
+        ctype = ContentType.objects.get_for_model(TestingModel)
+        objs = [TestingModel.objects.create(pickle_field=i) for i in range(3)]
+        for obj in objs:
+            SuperTagProcessQueue.objects.create(content_type=ctype, object_id=obj.pk)
+        SuperTagProcessQueue.objects.create(content_type=ctype, object_id=999)
+        items = SuperTagProcessQueue.objects.claim('worker', 10)
+        self.assertNumQueries(1, Core().load_content_objects, items)
+        self.assertNumQueries(0, lambda: [i.content_object for i in items])
+        self.assertEquals([i.content_object for i in items], objs + [None])
+    
+    def testFilteredContentObjectsAreFound(self):
+        """Tests that objects a custom default manager hides are processed."""
+        from django.contrib.contenttypes.models import ContentType
+        from supertagging.models import SuperTagProcessQueue
+        from supertagging.management.commands.st_process_queue import Core
+        class HiddenManager(models.Manager):
+            def get_query_set(self):
+                return super(HiddenManager, self).get_query_set().none()
+        manager = HiddenManager()
+        manager.model = TestingModel
+        ctype = ContentType.objects.get_for_model(TestingModel)
+        obj = TestingModel.objects.create(pickle_field='draft')
+        SuperTagProcessQueue.objects.create(content_type=ctype, object_id=obj.pk)
+        items = SuperTagProcessQueue.objects.claim('worker', 10)
+        old_manager, TestingModel._default_manager = (
+            TestingModel._default_manager, manager)
+        try:
+            Core().load_content_objects(items)
+        finally:
+            TestingModel._default_manager = old_manager
+        self.assertEquals(items[0].content_object, obj)
+    
+    def testExpiredLeaseIsReclaimed(self):
+        """Tests that items of a dead worker are retried, then failed."""
+        import datetime
+        from django.contrib.contenttypes.models import ContentType
+        from supertagging import settings
+        from supertagging.models import SuperTagProcessQueue
+        ctype = ContentType.objects.get_for_model(TestingModel)
+        SuperTagProcessQueue.objects.create(content_type=ctype, object_id=1)
+        old_max = settings.QUEUE_MAX_ATTEMPTS
+        settings.QUEUE_MAX_ATTEMPTS = 2
+        try:
+            expired = datetime.datetime.now() - datetime.timedelta(
+                seconds=settings.QUEUE_LEASE_TIMEOUT + 1)
+            self.assertEquals(len(SuperTagProcessQueue.objects.claim('dead', 1)), 1)
+            self.assertEquals(SuperTagProcessQueue.objects.claim('other', 1), [])
+            SuperTagProcessQueue.objects.update(claimed_at=expired)
+            item = SuperTagProcessQueue.objects.claim('other', 1)[0]
+            self.assertEquals(item.attempts, 2)
+            SuperTagProcessQueue.objects.update(claimed_at=expired)
+            self.assertEquals(SuperTagProcessQueue.objects.claim('third', 1), [])
+            item = SuperTagProcessQueue.objects.get()
+            self.assertTrue(item.failed)
+            self.assertFalse(item.locked)
+        finally:
+            settings.QUEUE_MAX_ATTEMPTS = old_max
+
+
+    def testBatchedCommits(self):
+        """Tests that a failure only undoes its object and that queue items 
+        are removed in the commit that saves their tags."""
+        from django.contrib.contenttypes.models import ContentType
+        from supertagging.models import SuperTagProcessQueue, SuperTaggedItem
+        ctype = ContentType.objects.get_for_model(TestingModel)
+        objs = [TestingModel.objects.create(pickle_field=i) for i in range(5)]
+        for obj in objs:
+            SuperTagProcessQueue.objects.create(content_type=ctype, object_id=obj.pk)
+        def process(obj):
+            if obj == objs[1]:
+                raise ValueError('Failed')
+            tagged.append(obj.pk)
+        tagged = []
+        fake = run_queue(process, commit_every=3)
+        # Committed after three processed objects, then at the end of the batch
+        states = []
+        for queued, committed in fake.commits:
+            if committed and committed not in states:
+                states.append(committed)
+        self.assertEquals(states, [tagged[:3], tagged])
+        for queued, committed in fake.commits:
+            self.assertFalse(set(queued) & set(committed))
+        self.assertEquals(fake.rollbacks, [fake.savepoints[1]])
+        item = SuperTagProcessQueue.objects.get()
+        self.assertEquals((item.object_id, item.last_error), (objs[1].pk, 'Failed'))
+
+    def testStoppedDaemon(self):
+        """Tests that a stopped daemon finishes its batch and exits, and 
+        that a failed commit is rolled back without stopping it."""
+        from django.contrib.contenttypes.models import ContentType
+        from supertagging.models import SuperTagProcessQueue
+        from supertagging.management.commands.st_process_queue import _stop
+        ctype = ContentType.objects.get_for_model(TestingModel)
+        objs = [TestingModel.objects.create(pickle_field=i) for i in range(3)]
+        for obj in objs:
+            SuperTagProcessQueue.objects.create(content_type=ctype, object_id=obj.pk)
+        fake = RecordingTransaction()
+        def process(obj):
+            _stop.set()
+            if obj == objs[-1]:
+                fake.fail_commit = True
+        try:
+            run_queue(process, fake, daemon=True, batch_size=10)
+        finally:
+            _stop.clear()
+        self.assertEquals(fake.processed, [o.pk for o in objs])
+        self.assertEquals(fake.rollbacks, [None])
+
+    def testWorkersShareTheRate(self):
+        """Tests that each worker gets its share of the rate, every time."""
+        from supertagging import settings
+        from supertagging.management.commands import st_process_queue
+        rates = []
+        class FakeCore(object):
+            def __init__(self, requests_per_second=None, **options):
+                rates.append(requests_per_second)
+            def execute(self):
+                return 0, 0
+        old_rate = settings.OPEN_CALAIS['REQUESTS_PER_SECOND']
+        old_core, st_process_queue.Core = st_process_queue.Core, FakeCore
+        settings.OPEN_CALAIS['REQUESTS_PER_SECOND'] = 4
+        try:
+            for i in range(2):
+                st_process_queue.run_worker((2, {'batch_size': 10}))
+            self.assertEquals(settings.OPEN_CALAIS['REQUESTS_PER_SECOND'], 4)
+        finally:
+            settings.OPEN_CALAIS['REQUESTS_PER_SECOND'] = old_rate
+            st_process_queue.Core = old_core
+        self.assertEquals(rates, [2.0, 2.0])
+
+
+class RecordingTransaction(object):
+    """
+    Stands in for ``django.db.transaction`` in the queue command, keeping 
+    the queued and processed objects at each commit. The next commit 
+    fails when ``fail_commit`` is set.
+    """
+    def __init__(self):
+        self.processed, self.fail_commit = [], False
+        self.savepoints, self.rollbacks, self.commits = [], [], []
+    
+    def savepoint(self):
+        self.savepoints.append('s%s' % len(self.savepoints))
+        return self.savepoints[-1]
+    
+    def savepoint_commit(self, sid):
+        pass
+    
+    def savepoint_rollback(self, sid):
+        self.rollbacks.append(sid)
+    
+    def rollback(self):
+        self.rollbacks.append(None)
+    
+    def commit(self):
+        from django.db import DatabaseError
+        from supertagging.models import SuperTagProcessQueue
+        if self.fail_commit:
+            self.fail_commit = False
+            raise DatabaseError('Connection lost')
+        self.commits.append((list(SuperTagProcessQueue.objects.values_list(
+            'object_id', flat=True)), list(self.processed)))
+
+def run_queue(process, fake=None, **kwargs):
+    """
+    Drain the queue with a Core using ``process`` and a RecordingTransaction,
+    which is returned.
+    """
+    import sys
+    from StringIO import StringIO
+    from django.db import connection
+    from supertagging.management.commands import st_process_queue
+    fake = fake or RecordingTransaction()
+    def record(obj):
+        process(obj)
+        fake.processed.append(obj.pk)
+    old = (st_process_queue.process, st_process_queue.transaction, 
+        connection.features.uses_savepoints, sys.stdout)
+    st_process_queue.process = record
+    st_process_queue.transaction = fake
+    connection.features.uses_savepoints = True
+    sys.stdout = StringIO()
+    try:
+        st_process_queue.Core(**kwargs).execute()
+    finally:
+        (st_process_queue.process, st_process_queue.transaction, 
+            connection.features.uses_savepoints, sys.stdout) = old
+    return fake
+
+
+class BackgroundProcessorTests(TestCase):
+    def testFullBacklogIsRefused(self):
+        """Tests that objects past the backlog are refused."""
+        import threading
+        from supertagging.background import BackgroundProcessor
+        started, release, done = threading.Event(), threading.Event(), []
+        def target(ctype_id, object_id):
+            started.set()
+            release.wait(5)
+            done.append(object_id)
+        processor = BackgroundProcessor(1, 1, target)
+        self.assertTrue(processor.submit(1, 1))
+        started.wait(5)
+        self.assertTrue(processor.submit(1, 2))
+        self.assertFalse(processor.submit(1, 3))
+        release.set()
+        processor._tasks.join()
+        self.assertEquals(done, [1, 2])
+    
+    def testUncommittedSaveIsQueued(self):
+        """Tests that saves inside a transaction outside of a request fall 
+        back to the queue."""
+        from django.db import transaction
+        from supertagging.background import process_in_background
+        from supertagging.models import SuperTagProcessQueue
+        obj = TestingModel.objects.create(pickle_field='Barack Obama')
+        if not hasattr(transaction, 'on_commit'):
+            process_in_background(obj)
+            self.assertEquals(SuperTagProcessQueue.objects.count(), 1)
+    
+    def testSaveInRequestIsSubmittedAfterwards(self):
+        """Tests that saves inside a request's transaction are processed 
+        once the request is finished."""
+        from django.core.signals import request_started, request_finished
+        from django.db import transaction, close_connection
+        from supertagging import background
+        from supertagging.models import SuperTagProcessQueue
+        if hasattr(transaction, 'on_commit'):
+            return
+        submitted = []
+        class FakeProcessor(object):
+            def submit(self, ctype_id, object_id):
+                submitted.append(object_id)
+                return True
+        obj = TestingModel.objects.create(pickle_field='Barack Obama')
+        old_processor, background._processor = background._processor, FakeProcessor()
+        # Keep the test database open
+        request_finished.disconnect(close_connection)
+        try:
+            request_started.send(sender=None)
+            background.process_in_background(obj)
+            self.assertEquals(submitted, [])
+            request_finished.send(sender=None)
+        finally:
+            request_finished.connect(close_connection)
+            background._processor = old_processor
+        self.assertEquals(submitted, [obj.pk])
+        self.assertEquals(SuperTagProcessQueue.objects.count(), 0)
+
+
+class TaggedItemQueryTests(TestCase):
+    def testIntersectionAndUnion(self):
+        """Tests that tag queries stay lazy and count a tag once per object."""
+        from django.contrib.contenttypes.models import ContentType
+        from supertagging.models import SuperTag, SuperTaggedItem
+        ctype = ContentType.objects.get_for_model(TestingModel)
+        a, b = [SuperTag.objects.create(calais_id=n, name=n, slug=n, stype='Person')
+            for n in ('a', 'b')]
+        objs = [TestingModel.objects.create(pickle_field=i) for i in range(3)]
+        for obj, tag, field in ((objs[0], a, 'body'), (objs[0], b, 'body'),
+            (objs[1], a, 'body'), (objs[1], a, 'title'), (objs[2], b, 'body')):
+            SuperTaggedItem.objects.create(tag=tag, content_type=ctype,
+                object_id=obj.pk, field=field)
+        with self.assertNumQueries(0):
+            both = SuperTaggedItem.objects.get_intersection_by_model(TestingModel, [a, b])
+        self.assertEquals(list(both), [objs[0]])
+        either = SuperTaggedItem.objects.get_union_by_model(TestingModel, [a, b])
+        self.assertEquals(sorted([o.pk for o in either]), [o.pk for o in objs])
+
+    def testKeptFieldKeepsRelations(self):
+        """Tests that removing a field's items leaves other fields' relations."""
+        from django.contrib.contenttypes.models import ContentType
+        from supertagging.models import (SuperTag, SuperTagRelation,
+            SuperTaggedItem, SuperTaggedRelationItem)
+        from supertagging.modules import _sync_tagged_items
+        ctype = ContentType.objects.get_for_model(TestingModel)
+        tag = SuperTag.objects.create(calais_id='a', name='a', slug='a',
+            stype='Person')
+        relation = SuperTagRelation.objects.create(tag=tag, stype='Quotation',
+            name='quote')
+        obj = TestingModel.objects.create(pickle_field='a')
+        for field in ('title', 'body'):
+            SuperTaggedItem.objects.create(tag=tag, content_type=ctype,
+                object_id=obj.pk, field=field)
+            SuperTaggedRelationItem.objects.create(relation=relation,
+                content_type=ctype, object_id=obj.pk, field=field)
+        _sync_tagged_items(ctype, obj, {}, ['title'])
+        self.assertEquals(list(SuperTaggedRelationItem.objects.values_list(
+            'field', flat=True)), ['title'])
+
+
+ENTITY_RESPONSE = """{
+    "doc": {"info": {"calaisRequestID": "1"}, "meta": {"language": "English"}},
+    "http://d.opencalais.com/pershash-1/obama": {
+        "_typeGroup": "entities", "_type": "Person", "name": "Barack Obama",
+        "relevance": 0.8, "instances": [
+            {"exact": "Barack Obama", "offset": 0, "length": 12}]},
+    "http://d.opencalais.com/pershash-1/obama-short": {
+        "_typeGroup": "entities", "_type": "Person", "name": "Barack Obama",
+        "relevance": 0.5, "instances": [
+            {"exact": "Obama", "offset": 20, "length": 5}]}
+}"""
+
+class ProcessTests(TestCase):
+    def setUp(self):
+        from supertagging import settings
+        from supertagging.calais import Calais
+        from supertagging.models import tag_cache
+        tag_cache.clear()
+        self.old_settings = dict([(k, getattr(settings, k)) for k in 
+            ('ENABLED', 'API_KEY', 'MODULES')])
+        settings.ENABLED = True
+        settings.API_KEY = 'test'
+        settings.MODULES = {'supertagging.testingmodel': {
+            'fields': [{'name': 'pickle_field'}]}}
+        self.calls = []
+        self.old_rest_POST = Calais.rest_POST
+        def rest_POST(calais, content, *args, **kwargs):
+            self.calls.append(content)
+            return self.response
+        Calais.rest_POST = rest_POST
+        self.response = ENTITY_RESPONSE
+        return super(ProcessTests, self).setUp()
+    
+    def tearDown(self):
+        from supertagging import settings
+        from supertagging.calais import Calais
+        for k, v in self.old_settings.items():
+            setattr(settings, k, v)
+        Calais.rest_POST = self.old_rest_POST
+    
+    def testMergedItems(self):
+        """Tests that one item is written per tag and field."""
+        from supertagging.models import SuperTaggedItem
+        from supertagging.modules import process
+        obj = TestingModel.objects.create(pickle_field='Barack Obama said Obama')
+        process(obj)
+        items = SuperTaggedItem.objects.all()
+        self.assertEquals(len(items), 1)
+        self.assertEquals(items[0].relevance, 800)
+        self.assertEquals([i['offset'] for i in items[0].instances], [0, 20])
+
+    def testNormalizedNameLookup(self):
+        """Tests that tags are found by their normalized name."""
+        from supertagging.models import SuperTag, SuperTaggedItem
+        from supertagging.modules import process
+        from supertagging.utils import get_tag
+        tag = SuperTag.objects.create(calais_id='other', name='Barack  OBAMA',
+            slug='barack-obama', stype='Person')
+        self.assertEquals(tag.normalized_name, 'barack obama')
+        self.assertEquals(get_tag('barack obama'), tag)
+        obj = TestingModel.objects.create(pickle_field='Barack Obama said Obama')
+        process(obj)
+        self.assertEquals(SuperTaggedItem.objects.get().tag, tag)
+
+    def testReprocessKeepsUnchangedItems(self):
+        """Tests that reprocessing only writes the tags that changed."""
+        from supertagging.models import SuperTaggedItem
+        from supertagging.modules import process
+        obj = TestingModel.objects.create(pickle_field='Barack Obama said Obama')
+        process(obj)
+        item = SuperTaggedItem.objects.get()
+        process(obj, force=True)
+        self.assertEquals(SuperTaggedItem.objects.get().pk, item.pk)
+        self.response = ENTITY_RESPONSE.replace('obama-short', 'biden').replace(
+            '"Barack Obama",\n        "relevance": 0.5', 
+            '"Joe Biden",\n        "relevance": 0.5')
+        process(obj, force=True)
+        self.assertEquals(SuperTaggedItem.objects.get(tag__name='barack obama').pk, item.pk)
+        self.assertEquals(SuperTaggedItem.objects.count(), 2)
+
+    def testUsageCounts(self):
+        """Tests that usage counts follow processing, ignoring and clean up."""
+        from supertagging.models import SuperTag, SuperTaggedItem
+        from supertagging.modules import process, clean_up
+        def usage(**kwargs):
+            return dict([(t.name, t.count) for t in
+                SuperTag.objects.usage_for_model(TestingModel, counts=True, **kwargs)])
+        objs = [TestingModel.objects.create(pickle_field='Barack Obama said Obama')
+            for i in range(2)]
+        for obj in objs:
+            process(obj)
+        self.assertEquals(usage(), {'barack obama': 2})
+        self.assertEquals(usage(filters={'pk__in': [o.pk for o in objs]}),
+            {'barack obama': 2})
+        item = SuperTaggedItem.objects.get(object_id=objs[0].pk)
+        item.ignore = True
+        item.save()
+        self.assertEquals(usage(), {'barack obama': 1})
+        self.assertEquals(usage(filters={'pk__in': [o.pk for o in objs]}),
+            {'barack obama': 1})
+        clean_up(objs[1])
+        self.assertEquals(usage(), {})
+
+    def testCachedTagCloud(self):
+        """Tests that the cached cloud is refreshed when items change."""
+        from django.template import Template, Context
+        from supertagging import settings
+        from supertagging.modules import process
+        template = Template('{% load supertagging_tags %}'
+            '{% supertag_cloud_for_model supertagging.testingmodel as tags %}'
+            '{% for tag in tags %}{{ tag.name }}:{{ tag.count }}{% endfor %}')
+        old_timeout, settings.USAGE_CACHE_TIMEOUT = settings.USAGE_CACHE_TIMEOUT, 60
+        try:
+            process(TestingModel.objects.create(pickle_field='Barack Obama'))
+            self.assertEquals(template.render(Context()), 'barack obama:1')
+            self.assertNumQueries(0, template.render, Context())
+            process(TestingModel.objects.create(pickle_field='Barack Obama'))
+            self.assertEquals(template.render(Context()), 'barack obama:2')
+        finally:
+            settings.USAGE_CACHE_TIMEOUT = old_timeout
+
+    def testUnchangedContentIsSkipped(self):
+        """Tests that unchanged text is not sent to Calais again."""
+        from supertagging.modules import process
+        obj = TestingModel.objects.create(pickle_field='Barack Obama said Obama')
+        process(obj)
+        process(obj)
+        self.assertEquals(len(self.calls), 1)
+        process(obj, force=True)
+        self.assertEquals(len(self.calls), 2)
+        obj.pickle_field = 'Barack Obama said Obama again'
+        process(obj)
+        self.assertEquals(len(self.calls), 3)
+
+    def testFailedFieldIsNotSkipped(self):
+        """Tests that a field whose entities failed is processed again."""
+        from supertagging import modules
+        obj = TestingModel.objects.create(pickle_field='Barack Obama said Obama')
+        modules.process(obj)
+        def fail(*args, **kwargs):
+            raise ValueError('Failed')
+        old_processEntities, modules._processEntities = modules._processEntities, fail
+        try:
+            modules.process(obj, force=True)
+        finally:
+            modules._processEntities = old_processEntities
+        modules.process(obj)
+        self.assertEquals(len(self.calls), 3)
+
+    def testSingleRequest(self):
+        """Tests that fields sent together are mapped back to each field."""
+        from supertagging import settings
+        from supertagging.models import SuperTaggedItem
+        from supertagging.modules import process
+        settings.MODULES = {'supertagging.testingmodel': {
+            'fields': [{'name': 'pickle_field'}, 
+                {'name': 'summary', 'combine_fields': ['pickle_field']}],
+            'single_request': True}}
+        self.response = ENTITY_RESPONSE.replace(
+            '"offset": 0, "length": 12}]', 
+            '"offset": 0, "length": 12}, {"exact": "Barack Obama", '
+            '"offset": 25, "length": 12}]')
+        obj = TestingModel.objects.create(pickle_field='Barack Obama said Obama')
+        process(obj)
+        self.assertEquals(self.calls, [u'Barack Obama said Obama\n\n'
+            u'Barack Obama said Obama'])
+        items = dict([(i.field, i) for i in SuperTaggedItem.objects.all()])
+        self.assertEquals([i['offset'] for i in items['pickle_field'].instances], [0, 20])
+        self.assertEquals([i['offset'] for i in items['summary'].instances], [0])
+    
+    def testAnalyzeMany(self):
+        """Tests that concurrent results map back to their input keys."""
+        from supertagging.calais import Calais, CalaisResponse
+        c = Calais('test')
+        def rest_POST(content, content_type=None):
+            if content == 'fail':
+                raise IOError(content)
+            return self.response
+        c.rest_POST = rest_POST
+        results = dict(c.analyze_many({'a': 'Barack Obama', 'b': 'fail', 
+            'c': ' '}, max_workers=2))
+        self.assertTrue(isinstance(results['a'], CalaisResponse))
+        self.assertTrue(isinstance(results['b'], IOError))
+        self.assertEquals(results['c'], None)
+
+    def testWorkersAreReused(self):
+        """Tests that every call sends its requests with the same threads."""
+        import threading
+        from supertagging.calais import Calais, get_worker_pool
+        c = Calais('test')
+        c.rest_POST = lambda content, content_type=None: self.response
+        self.assertTrue(get_worker_pool(3) is get_worker_pool(3))
+        dict(c.analyze_many(['Barack Obama'] * 5, max_workers=3))
+        threads = threading.active_count()
+        for i in range(3):
+            results = dict(c.analyze_many(['Barack Obama'] * 5, max_workers=3))
+            self.assertEquals(sorted(results), range(5))
+        self.assertEquals(threading.active_count(), threads)
+
+    def testChunkedDocument(self):
+        """Tests that a long text is split and the responses merged."""
+        from supertagging.calais import Calais
+        c = Calais('test')
+        calls = []
+        def rest_POST(content, content_type=None):
+            calls.append(content)
+            return ENTITY_RESPONSE.replace('0.8', content.endswith('left.') and '0.9' or '0.7')
+        c.rest_POST = rest_POST
+        results = dict(c.analyze_many(['Barack Obama spoke.\n\nBarack Obama left.'],
+            max_size=25))
+        self.assertEquals(sorted(calls), ['Barack Obama left.', 'Barack Obama spoke.\n\n'])
+        entities = dict([(e['__reference'], e) for e in results[0].entities])
+        obama = entities['http://d.opencalais.com/pershash-1/obama']
+        self.assertEquals(obama['relevance'], 0.9)
+        self.assertEquals([i['offset'] for i in obama['instances']], [0, 21])
+        self.assertEquals(len(entities), 2)
+
+    def testOfflineReprocess(self):
+        """Tests that stored responses are reused without calling Calais."""
+        from supertagging import settings
+        from supertagging.models import SuperTaggedItem
+        from supertagging.modules import process
+        old_store, old_relevance = settings.RESPONSE_STORE, settings.MIN_RELEVANCE
+        settings.RESPONSE_STORE = {
+            'BACKEND': 'supertagging.stores.DatabaseResponseStore'}
+        try:
+            obj = TestingModel.objects.create(pickle_field='Barack Obama said Obama')
+            process(obj)
+            settings.MIN_RELEVANCE = 600
+            process(obj, offline=True)
+        finally:
+            settings.RESPONSE_STORE = old_store
+            settings.MIN_RELEVANCE = old_relevance
+        self.assertEquals(len(self.calls), 1)
+        item = SuperTaggedItem.objects.get()
+        self.assertEquals([i['offset'] for i in item.instances], [0])
+
+    def testReprocessBatches(self):
+        """Tests that st_reprocess finds each stored object once."""
+        from django.contrib.contenttypes.models import ContentType
+        from supertagging import settings
+        from supertagging.models import SuperTagContentFingerprint
+        from supertagging.modules import process
+        from supertagging.management.commands.st_reprocess import Core
+        old_store, old_skip = settings.RESPONSE_STORE, settings.SKIP_UNCHANGED_CONTENT
+        settings.RESPONSE_STORE = {
+            'BACKEND': 'supertagging.stores.DatabaseResponseStore'}
+        settings.SKIP_UNCHANGED_CONTENT = False
+        try:
+            objs = [TestingModel.objects.create(pickle_field='Barack Obama')
+                for i in range(2)]
+            for obj in objs:
+                process(obj)
+        finally:
+            settings.RESPONSE_STORE = old_store
+            settings.SKIP_UNCHANGED_CONTENT = old_skip
+        SuperTagContentFingerprint.objects.create(object_id=objs[0].pk,
+            content_type=ContentType.objects.get_for_model(TestingModel),
+            field='other', fingerprint='x')
+        batches = list(Core(batch_size=1).get_batches())
+        self.assertEquals([ids for ctype_id, ids in batches],
+            [[objs[0].pk], [objs[1].pk]])
+
+
+class AdminTests(TestCase):
+    def testUpdateTagsWhilePaused(self):
+        """Tests that updating tags while Calais is paused queues the object."""
+        from django.contrib import admin
+        from django.contrib.contenttypes.models import ContentType
+        from django.test.client import RequestFactory
+        from supertagging import modules
+        from supertagging.admin import SuperTaggedItemAdmin
+        from supertagging.calais import CircuitOpen
+        from supertagging.models import SuperTaggedItem, SuperTagProcessQueue
+        obj = TestingModel.objects.create(pickle_field='Barack Obama')
+        request = RequestFactory().post('/?content_type__id=%s&object_id=%s' % (
+            ContentType.objects.get_for_model(TestingModel).pk, obj.pk),
+            {'_update_tags': '1'})
+        model_admin = SuperTaggedItemAdmin(SuperTaggedItem, admin.site)
+        messages = []
+        model_admin.message_user = lambda request, msg: messages.append(msg)
+        def process(obj, **kwargs):
+            raise CircuitOpen('OpenCalais failed 5 times in a row.')
+        old_process, modules.process = modules.process, process
+        try:
+            response = model_admin.changelist_view(request)
+        finally:
+            modules.process = old_process
+        self.assertEquals(response.status_code, 302)
+        self.assertTrue(messages[0].startswith('Tagging is paused'))
+        self.assertEquals(SuperTagProcessQueue.objects.get().object_id, obj.pk)
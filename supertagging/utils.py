@@ -4,6 +4,8 @@
 
 import math
 import types
+import threading
+from collections import OrderedDict
 from django.db.models.query import QuerySet
 from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext as _
@@ -173,8 +175,9 @@ def get_tag_list(tags):
     elif isinstance(tags, QuerySet) and tags.model is SuperTag:
         return tags
     elif isinstance(tags, types.StringTypes):
-        return SuperTag.objects.filter(name__in=parse_tag_input(tags))\
-                |SuperTag.objects.filter(slug__in=parse_tag_input(tags))
+        names = parse_tag_input(tags)
+        return SuperTag.objects.filter(normalized_name__in=[normalize_tag_name(tag) for tag in names])\
+                |SuperTag.objects.filter(slug__in=names)
     elif isinstance(tags, (types.ListType, types.TupleType)):
         if len(tags) == 0:
             return tags
@@ -182,13 +185,13 @@ def get_tag_list(tags):
         for item in tags:
             if isinstance(item, types.StringTypes):
                 contents.add('string')
-            elif isinstance(item, Tag):
+            elif isinstance(item, SuperTag):
                 contents.add('tag')
             elif isinstance(item, (types.IntType, types.LongType)):
                 contents.add('int')
         if len(contents) == 1:
             if 'string' in contents:
-                return SuperTag.objects.filter(name__in=[force_unicode(tag) for tag in tags])\
+                return SuperTag.objects.filter(normalized_name__in=[normalize_tag_name(tag) for tag in tags])\
                         |SuperTag.objects.filter(slug__in=[force_unicode(tag) for tag in tags])
             elif 'tag' in contents:
                 return tags
@@ -206,7 +209,7 @@ def get_tag(tag):
 
     If a ``Tag`` object is given it will be returned as-is; if a
     string or integer are given, they will be used to lookup the
-    appropriate ``Tag``.
+    appropriate ``Tag``. Names are compared after ``normalize_tag_name``.
 
     If no matching tag can be found, ``None`` will be returned.
     """
@@ -216,10 +219,11 @@ def get_tag(tag):
 
     try:
         if isinstance(tag, types.StringTypes):
-            return SuperTag.objects.get(name=tag)
+            # A name can be shared by tags of different types
+            return SuperTag.objects.filter(normalized_name=normalize_tag_name(tag))[0]
         elif isinstance(tag, (types.IntType, types.LongType)):
             return SuperTag.objects.get(id=tag)
-    except SuperTag.DoesNotExist:
+    except (SuperTag.DoesNotExist, IndexError):
         pass
 
     return None
@@ -270,7 +274,171 @@ def calculate_cloud(tags, steps=4, distribution=LOGARITHMIC):
                     tag.font_size = i + 1
                     font_set = True
     return tags
-    
+
+###############
+# Cache Utils #
+###############
+
+def normalize_tag_name(name):
+    """
+    Lowercases ``name`` and collapses runs of whitespace, so that the
+    different spellings Calais returns for the same entity compare equal.
+    """
+    return u' '.join(force_unicode(name).lower().split())
+
+class LRUCache(object):
+    """
+    A small, thread safe, least recently used cache. Once ``size`` keys
+    are stored, setting a new key evicts the one used longest ago. A
+    ``size`` of ``0`` disables the cache.
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            # Re-insert the key to mark it as the most recently used
+            self._data[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        if not self.size:
+            return
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def delete_matching(self, test):
+        """
+        Remove every entry for which ``test(key, value)`` is true.
+        """
+        self._lock.acquire()
+        try:
+            for key, value in self._data.items():
+                if test(key, value):
+                    del self._data[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+###########################
+#    Commit Callbacks     #
+###########################
+
+from django.core.signals import request_started, request_finished, got_request_exception
+from django.db import transaction
+
+# Callbacks waiting for the transaction of the current thread to commit
+_commit_callbacks = threading.local()
+
+def on_commit(func, key=None):
+    """
+    Call ``func`` once the current transaction is committed, or straight
+    away when there is no transaction. Only one callback with the same
+    ``key`` waits at a time.
+
+    Before Django 1.9 a transaction can't report its commit. Callbacks then
+    wait for the end of the request, or for ``run_commit_callbacks`` in
+    code that called ``start_commit_callbacks`` and commits itself.
+    Elsewhere the callback is not scheduled and False is returned.
+    """
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(func)
+        return True
+    if not transaction.is_managed():
+        func()
+        return True
+    callbacks = getattr(_commit_callbacks, 'callbacks', None)
+    if callbacks is None:
+        return False
+    if key is None or key not in [k for k, f in callbacks]:
+        callbacks.append((key, func))
+    return True
+
+def start_commit_callbacks():
+    """
+    Collect the callbacks of transactions in this thread from now on.
+    """
+    _commit_callbacks.callbacks = []
+
+def stop_commit_callbacks():
+    """
+    Stop collecting callbacks, dropping the waiting ones.
+    """
+    _commit_callbacks.callbacks = None
+
+def run_commit_callbacks():
+    """
+    Call the waiting callbacks, after the transaction was committed.
+    """
+    callbacks = getattr(_commit_callbacks, 'callbacks', None)
+    while callbacks:
+        key, func = callbacks.pop(0)
+        func()
+
+def discard_commit_callbacks(mark=0):
+    """
+    Drop the callbacks added since ``mark``, as returned by
+    ``commit_callbacks_mark``, after a rollback.
+    """
+    callbacks = getattr(_commit_callbacks, 'callbacks', None)
+    if callbacks:
+        del callbacks[mark:]
+
+def commit_callbacks_mark():
+    """
+    The position to pass ``discard_commit_callbacks`` when rolling back
+    to a savepoint taken now.
+    """
+    return len(getattr(_commit_callbacks, 'callbacks', None) or [])
+
+def _request_started(sender, **kwargs):
+    start_commit_callbacks()
+
+def _request_failed(sender, **kwargs):
+    # The transaction of the request is rolled back
+    discard_commit_callbacks()
+
+def _request_finished(sender, **kwargs):
+    try:
+        run_commit_callbacks()
+    finally:
+        stop_commit_callbacks()
+
+request_started.connect(_request_started)
+got_request_exception.connect(_request_failed)
+request_finished.connect(_request_finished)
+
 ###########################
 # Freebase Util Functions #
 ###########################